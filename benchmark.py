@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import io
+import json
+import time
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+import argparse
+from pathlib import Path
+
+import update
+
+class NoLedger:
+    ''' A Ledger in which nothing has been reported yet so that every
+    match is rendered. '''
+    def isDone(self, kind, league, key):
+        return False
+
+def measure(stage, setup, repeats):
+    ''' Run stage(setup()) repeats times for the best wall time and once
+    more under tracemalloc for the peak memory it allocates. Anything the
+    stage prints is discarded.
+
+    Returns: result - a dictionary of seconds and peak bytes
+             value - what the stage returned
+
+    '''
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            arg = setup()
+            start = time.perf_counter()
+            value = stage(arg)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best: best = elapsed
+        arg = setup()
+        tracemalloc.start()
+        stage(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": best, "peak": peak}, value
+
+def renderReports(leagues):
+    ''' Build every report email as update.py would without queueing or
+    sending any. '''
+    ledger = NoLedger()
+    for league in leagues.values():
+        league.reportResults(None, ledger)
+        league.reportToOppos(None, ledger)
+
+def runBenchmark(configFile, repeats):
+    ''' Time each stage of producing the tables and reports for a season.
+
+    Returns: stages - a dictionary of results indexed by stage name
+             counts - the size of the data set
+
+    '''
+    captains, results, corrections, people, fixtures = update.readConfig(configFile)
+    update.mailWanted = update.reportWanted = update.printWanted = False
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as cold, tempfile.TemporaryDirectory() as warm:
+        stages["getCordict"], cordict = measure(lambda d: update.getCordict(corrections, d), lambda: tempfile.mkdtemp(dir=cold), repeats)
+        update.getCordict(corrections, warm)
+        stages["getCordict (cached)"], _ = measure(lambda d: update.getCordict(corrections, d), lambda: warm, repeats)
+
+    stages["readResults"], data = measure(lambda c: list(update.readResults(results, c)), lambda: dict(cordict), repeats)
+    stages["getLeagues"], leagues = measure(lambda _: update.getLeagues(captains, people, False, fixtures), lambda: None, repeats)
+
+    def fresh():
+        return update.getLeagues(captains, people, False, fixtures)
+    stages["populateLeagues"], _ = measure(lambda l: update.populateLeagues(data, l), fresh, repeats)
+    update.populateLeagues(data, leagues)
+
+    stages["League.table"], _ = measure(lambda l: [league.table() for league in l.values()], lambda: leagues, repeats)
+    stages["League.gamesTable"], _ = measure(lambda l: [league.gamesTable() for league in l.values()], lambda: leagues, repeats)
+    stages["reports"], _ = measure(renderReports, lambda: leagues, repeats)
+
+    counts = {"responses": len(data), "corrections": len(cordict), "games": sum(len(league.games) for league in leagues.values()),
+              "teams": sum(len(league.teams) for league in leagues.values())}
+    return stages, counts
+
+def gitCommit():
+    ''' Return the commit of the update.py being timed or None if it is
+    not in a git checkout. '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(update.__file__).resolve().parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def printStages(stages, previous=None):
+    ''' Print the results with the change from a previous run if given. '''
+    print ("%-22s %10s %12s" % ("Stage", "ms", "peak KiB") + ("  vs previous" if previous else ""))
+    for name, result in stages.items():
+        line = "%-22s %10.1f %12.1f" % (name, result["seconds"] * 1000, result["peak"] / 1024)
+        if previous and name in previous:
+            old = previous[name]
+            line += "  time x%.2f, memory x%.2f" % (result["seconds"] / old["seconds"] if old["seconds"] else 0, result["peak"] / old["peak"] if old["peak"] else 0)
+        print (line)
+
+def main():
+    ''' Main program. '''
+
+    parser = argparse.ArgumentParser(description="Time each stage of update.py on a season, such as one made by generate.py.")
+    parser.add_argument("configfile", help="name of the config file without the .ini")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="runs of each stage, the best time is kept")
+    parser.add_argument("-o", "--output", help="json file to save the results in")
+    parser.add_argument("-c", "--compare", help="json file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    stages, counts = runBenchmark(args.configfile, args.repeats)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["stages"]
+    print (counts)
+    printStages(stages, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"commit": gitCommit(), "config": args.configfile, "repeats": args.repeats, "counts": counts, "stages": stages}, f, indent=1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import csv
+import random
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+leagueNames = ['A Level','B Level','C Level','Hcap N','Hcap S']
+peels = ["", "", "", "TP", "QP", "SP", "TPO", "QPO"]
+
+def resultsHeader():
+    ''' The columns of the form responses csv. '''
+    header = ["Timestamp", "Email address", "Email of opponents captain", "League", "Date", "Venue", "Home team", "Away team"]
+    for i in range(1, 5):
+        header.extend(["Home player name " + str(i), "Home player handicap " + str(i), "Home player hoops scored " + str(i),
+                       "Away player name " + str(i), "Away player handicap " + str(i), "Away player hoops scored " + str(i),
+                       "Peeling abbreviation " + str(i)])
+        if i < 4: header.append("More games to record?")
+    return header
+
+def makeClubs(rng, clubCount, playersPerClub):
+    ''' Return a dictionary of club name to (captain email, list of
+    (player name, handicap)). '''
+    clubs = {}
+    for c in range(clubCount):
+        club = "Club " + str(c)
+        players = [("Player " + str(c) + "-" + str(p), str(rng.choice([-3, -2, -1, 0, 0.5, 1, 2, 3, 4, 5, 6, 8, 10, 12, 14, 16, 18, 20, 24]))) for p in range(playersPerClub)]
+        clubs[club] = ("captain" + str(c) + "@example.org", players)
+    return clubs
+
+def writeCaptains(fname, rng, clubs, entryRate):
+    ''' Write the captains csv with each club entering each league with
+    probability entryRate.
+
+    Returns: entries - a dictionary of league name to {club: games}
+
+    '''
+    entries = {name: {} for name in leagueNames}
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Club", "Given", "Surname", "Email", "Mobile", "Home"] + leagueNames + ["Short", "Leagues"])
+        for club, (email, players) in clubs.items():
+            counts = []
+            for name in leagueNames:
+                games = rng.choice([3, 4]) if rng.random() < entryRate else 0
+                if games: entries[name][club] = games
+                counts.append(games)
+            writer.writerow([club, "Given", "Captain of " + club, email, "", ""] + counts + [0, ""])
+    return entries
+
+def makeGame(rng, clubs, home, away):
+    ''' Return the seven values describing one game. '''
+    h_name, h_hcap = rng.choice(clubs[home][1])
+    a_name, a_hcap = rng.choice(clubs[away][1])
+    loser = rng.randint(0, 25)
+    winner = 26 if rng.random() < 0.8 else rng.randint(loser + 1, 25) if loser < 25 else 26
+    h_score, a_score = (winner, loser) if rng.random() < 0.5 else (loser, winner)
+    return [h_name, h_hcap, str(h_score), a_name, a_hcap, str(a_score), rng.choice(peels) if 26 in (h_score, a_score) else ""]
+
+def writeResults(fname, rng, clubs, entries, matchLimit, duplicateRate, start):
+    ''' Write the form responses csv. Each match played is reported in
+    one response of up to four games and with probability duplicateRate
+    is reported again by the other captain.
+
+    Returns: timestamps - the timestamp of each response
+
+    '''
+    matches = []
+    for name, teams in entries.items():
+        teams = sorted(teams)
+        for i, t1 in enumerate(teams):
+            for t2 in teams[i + 1:]:
+                matches.append((name, t1, t2, min(entries[name][t1], entries[name][t2])))
+    rng.shuffle(matches)
+    if matchLimit is not None: matches = matches[:matchLimit]
+
+    timestamps = []
+    when = start
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(resultsHeader())
+        for name, t1, t2, planned in matches:
+            home, away = (t1, t2) if rng.random() < 0.5 else (t2, t1)
+            when += timedelta(seconds=rng.randint(60, 3600))
+            day = (when - timedelta(days=rng.randint(0, 3))).strftime("%d/%m/%Y")
+            games = []
+            for g in range(min(planned, 4)):
+                games.extend(makeGame(rng, clubs, home, away))
+                if g < 3: games.append("Yes" if g < min(planned, 4) - 1 else "No")
+            games.extend([""] * (len(resultsHeader()) - 8 - len(games)))
+            reporters = [(clubs[home][0], clubs[away][0])]
+            if rng.random() < duplicateRate: reporters.append((clubs[away][0], clubs[home][0]))
+            for reporter, witness in reporters:
+                ts = when.strftime("%d/%m/%Y %H:%M:%S")
+                writer.writerow([ts, reporter, witness, name, day, home, home, away] + games)
+                timestamps.append(ts)
+                when += timedelta(seconds=rng.randint(1, 600))
+    return timestamps
+
+def writeCorrections(fname, rng, timestamps, correctionRate):
+    ''' Write a corrections file touching a correctionRate share of the
+    responses, mostly renaming a player and sometimes deleting. '''
+    with open(fname, 'w') as f:
+        for ts in rng.sample(timestamps, int(len(timestamps) * correctionRate)):
+            if rng.random() < 0.2:
+                f.write('"ts":"' + ts + '", "op":"delete"\n')
+            else:
+                f.write('"ts":"' + ts + '", "op":"update", "Home player name 1":"Corrected Name"\n')
+
+def main():
+    ''' Main program. '''
+
+    parser = argparse.ArgumentParser(description="Generate synthetic SCF league data for benchmarking update.py.")
+    parser.add_argument("-d", "--directory", default="synthetic", help="where to put the files and the config file")
+    parser.add_argument("-n", "--name", default="synthetic", help="name of the config file and prefix of the data files")
+    parser.add_argument("--clubs", type=int, default=60)
+    parser.add_argument("--players", type=int, default=12, help="players per club")
+    parser.add_argument("--entry-rate", type=float, default=0.7, help="chance of a club entering each league")
+    parser.add_argument("--matches", type=int, default=None, help="limit on the number of matches reported")
+    parser.add_argument("--duplicates", type=float, default=0.02, help="share of matches reported twice")
+    parser.add_argument("--corrections", type=float, default=0.05, help="share of responses corrected")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = Path(args.directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    prefix = str(directory / args.name)
+
+    clubs = makeClubs(rng, args.clubs, args.players)
+    entries = writeCaptains(prefix + "-captains.csv", rng, clubs, args.entry_rate)
+    timestamps = writeResults(prefix + "-results.csv", rng, clubs, entries, args.matches, args.duplicates, datetime(2023, 4, 1))
+    writeCorrections(prefix + ".corrections", rng, timestamps, args.corrections)
+    with open(prefix + ".ini", 'w') as f:
+        f.write("[people]\nrankings = rankings@example.org\nobserver = observer@example.org\n\n")
+        f.write("[files]\ncorrections=" + prefix + ".corrections\nresults=" + prefix + "-results.csv\ncaptains=" + prefix + "-captains.csv\n")
+    print ("Wrote", len(timestamps), "responses for", args.clubs, "clubs; config is", prefix)
+
+if __name__ == '__main__': main()
@@ -1,16 +1,44 @@
 #!/usr/bin/env python
 import csv
 import sys
+import os
+import io
+import hashlib
+import pickle
+import asyncio
+import gzip
+import urllib.parse
+import shutil
+import subprocess
+import time
+import mmap
+import struct
+import difflib
+import cProfile
+import threading
+import concurrent.futures
+import itertools
+import contextlib
+import sqlite3
 import configparser
 import json
 import smtplib
 import ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime
-import html2text
+from datetime import datetime, date, timedelta
+from fractions import Fraction
+from array import array
 import argparse
 from pathlib import Path
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class Captain:
     ''' A Captain knows the name of his team along with his own name and email.'''
@@ -23,225 +51,621 @@ class Captain:
     def __str__(self):
         return self.team + ": " + self.given + " " + self.surname + " <" + self.email +">"
 
+class CrossTable:
+    ''' The number of games each team has won against each other team,
+    indexed by team number. A NumPy matrix is used if wanted and NumPy
+    is installed, otherwise a dictionary holding only the pairs of teams
+    that have played. '''
+    def __init__(self, n, useNumpy=False):
+        self.n = n
+        self.numpy = useNumpy and numpy is not None
+        if self.numpy:
+            self.wins = numpy.zeros((n, n), dtype=int)
+        else:
+            self.wins = {}
+
+    def add(self, winner, loser):
+        ''' Count a game won by team winner against team loser. '''
+        if self.numpy:
+            self.wins[winner, loser] += 1
+        else:
+            self.wins[winner, loser] = self.wins.get((winner, loser), 0) + 1
+
+    def get(self, i, j):
+        ''' Return the number of games team i has won against team j. '''
+        if self.numpy: return int(self.wins[i, j])
+        return self.wins.get((i, j), 0)
+
+    def copy(self):
+        ''' Return an independent copy, e.g. for trying out what-ifs. '''
+        other = CrossTable(0)
+        other.n = self.n
+        other.numpy = self.numpy
+        other.wins = self.wins.copy()
+        return other
+
+class Fixtures:
+    ''' The matches to be played in a league. Teams are numbered in
+    alphabetical order so a match between teams i < j is listed with
+    team i first. By default every team plays every other, the number of
+    games planned being the smaller of the two teams' numbers. Otherwise
+    an explicit list of (team, team, games) gives the matches, any that
+    cannot be played being reported and left out. '''
+    def __init__(self, teamGames, fixtureList=None, name=""):
+        teamGames = sorted(teamGames)
+        self.teams = [sys.intern(team) for team, games in teamGames]
+        self.number = {team: i for i, team in enumerate(self.teams)}
+        self.games = array("H", [games for team, games in teamGames])
+        self.explicit = None
+        if fixtureList is not None:
+            self.explicit = {}
+            for t1, t2, games in fixtureList:
+                keyText = "Fixture between " + t1 + " and " + t2 + " in " + name + " league"
+                if t1 not in self.number or t2 not in self.number or t1 == t2:
+                    print (keyText, "was unexpected.")
+                elif games < 1:
+                    print (keyText, "has no games planned.")
+                else:
+                    i, j = sorted((self.number[t1], self.number[t2]))
+                    self.explicit[i, j] = games
+
+    def __len__(self):
+        ''' The number of matches to be played. '''
+        if self.explicit is not None: return len(self.explicit)
+        return len(self.teams) * (len(self.teams) - 1) // 2
+
+    def isFixture(self, i, j):
+        ''' Return True if teams i < j are due to play. '''
+        if self.explicit is not None: return (i, j) in self.explicit
+        return i != j
+
+    def planned(self, i, j):
+        ''' Return the number of games planned between teams i < j. '''
+        if self.explicit is not None: return self.explicit[i, j]
+        return min(self.games[i], self.games[j])
+
+    def needed(self, i, j):
+        ''' Return the number of games needed to complete the match
+        between teams i < j. '''
+        return (self.planned(i, j) + 2)//2
+
+class StringTable:
+    ''' Each distinct string is stored once and referred to by number. '''
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, string):
+        ''' Return the number for a string, adding it if it is new. '''
+        try:
+            return self.codes[string]
+        except KeyError:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+            return code
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+def parseDate(date):
+    ''' Return the day number (as from date.toordinal) of a date typed in
+    as dd/mm/yyyy or dd/mm/yy or 0 if it cannot be understood. '''
+    for fmt in ("%d/%m/%Y", "%d/%m/%y"):
+        try:
+            return datetime.strptime(date.strip(), fmt).toordinal()
+        except ValueError:
+            pass
+    return 0
+
+def parseTimestamp(ts):
+    ''' Return the seconds since 1970 of a form timestamp or 0 if it
+    cannot be understood. The zero padded dd/mm/yyyy hh:mm:ss form is
+    picked apart directly as strptime is slow. '''
+    try:
+        if len(ts) == 19 and ts[2] + ts[5] + ts[10] + ts[13] + ts[16] == "// ::":
+            when = datetime(int(ts[6:10]), int(ts[3:5]), int(ts[0:2]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+        else:
+            when = datetime.strptime(ts, "%d/%m/%Y %H:%M:%S")
+    except ValueError:
+        return 0
+    return int((when - datetime(1970, 1, 1)).total_seconds())
+
+class GameStore:
+    ''' The games recorded in a league held column by column. Strings are
+    numbered using a StringTable, which may be shared between leagues,
+    and scores are held in arrays. The date and timestamp are also kept
+    as numbers so they can be compared without parsing. Each distinct
+    date or timestamp is only parsed once, the result being kept by its
+    string's number. '''
+    fields = ("h_team", "h_name", "h_handicap", "h_score", "a_team", "a_name", "a_handicap", "a_score", "pa", "date", "venue", "reporter", "witness", "timestamp")
+    scoreFields = ("h_score", "a_score")
+
+    def __init__(self, strings=None):
+        self.strings = StringTable() if strings is None else strings
+        self.columns = {}
+        for field in self.fields:
+            self.columns[field] = array("h" if field in self.scoreFields else "I")
+        self.order = [(self.columns[field], field in self.scoreFields) for field in self.fields]
+        self.days = array("l")
+        self.seconds = array("q")
+        self.parsedDays = {}
+        self.parsedSeconds = {}
+
+    def __len__(self):
+        return len(self.columns["h_score"])
+
+    def __getitem__(self, index):
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError(index)
+        return Game(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Game(self, index)
+
+    def append(self, *values):
+        ''' Add a game given its values in the order of fields. '''
+        code = self.strings.code
+        for (column, isScore), value in zip(self.order, values):
+            column.append(value if isScore else code(value))
+        day = self.columns["date"][-1]
+        if day not in self.parsedDays: self.parsedDays[day] = parseDate(self.strings[day])
+        self.days.append(self.parsedDays[day])
+        ts = self.columns["timestamp"][-1]
+        if ts not in self.parsedSeconds: self.parsedSeconds[ts] = parseTimestamp(self.strings[ts])
+        self.seconds.append(self.parsedSeconds[ts])
+
+    def value(self, field, index):
+        ''' Return a single value. '''
+        value = self.columns[field][index]
+        return value if field in self.scoreFields else self.strings[value]
+
+    def rows(self):
+        ''' Return an iterator giving each game as a tuple of its values in the order of
+        fields, as written to the games table. '''
+        strings = self.strings.strings
+        return zip(*(self.columns[field] if field in self.scoreFields else map(strings.__getitem__, self.columns[field]) for field in self.fields))
+
+class Game:
+    ''' A view of one game in a GameStore with the values available by
+    field name, e.g. game.h_team. '''
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def key(self):
+        ''' The key used for reports: date, venue, home team and away team. '''
+        return (self.date, self.venue, self.h_team, self.a_team)
+
+    @property
+    def day(self):
+        ''' The date of the game or None if it could not be understood. '''
+        day = self.store.days[self.index]
+        return date.fromordinal(day) if day else None
+
+    @property
+    def when(self):
+        ''' The time the result was submitted or None. '''
+        seconds = self.store.seconds[self.index]
+        return datetime(1970, 1, 1) + timedelta(seconds=seconds) if seconds else None
+
+def gameField(field):
+    return property(lambda game: game.store.value(field, game.index))
+
+for field in GameStore.fields:
+    setattr(Game, field, gameField(field))
+
 class League:
     ''' A specific league with its name and set of captains. '''
-    def __init__(self,name,captainGames,people):
+    def __init__(self,name,captainGames,people,useNumpy=False,fixtureList=None,strings=None):
         ''' Store the set of matches to be played. '''
         self.name = name
         self.captainGames = captainGames
-        self.matches = {}
-        self.games = []
-        self.planned_game_count = {}
-        self.min_game_count = {}
+        self.games = GameStore(strings)
         self.people = people
-        for cg1 in captainGames:
-            c1, g1 = cg1
-            for cg2 in captainGames:
-                c2, g2 = cg2
-                if c1.team < c2.team:
-                    self.matches[c1.team, c2.team] = []
-                    self.planned_game_count[c1.team, c2.team] =  min(g1,g2)
-                    self.min_game_count[c1.team, c2.team] = (self.planned_game_count[c1.team, c2.team] + 2)//2
+        self.fixtures = Fixtures([(c.team, g) for c, g in captainGames], fixtureList, name)
+        self.teams = self.fixtures.teams
+
+        # Running totals kept up to date by record
+        self.cross = CrossTable(len(self.teams), useNumpy)
+        self.played = [0] * len(self.teams)
+        self.pts = [0] * len(self.teams)
+        # The net wins of each team by the number of games planned in the match
+        self.game_diff = [{} for team in self.teams]
+        self.completed = 0
+        self.started = 0
+        self.version = 0
 
     def __str__(self):
         p = "League:" + self.name
-        completed = 0
-        started = 0
-        for m in self.matches:
-            mc = len(self.matches[m])
-            if mc >= self.min_game_count[m]: completed += 1
-            elif mc > 0: started += 1
-
-        return p + ", Completed:" + str(completed) + ", Started:" + str(started) + ", Not started:" + str(len(self.matches) - completed - started) 
+        return p + ", Completed:" + str(self.completed) + ", Started:" + str(self.started) + ", Not started:" + str(len(self.fixtures) - self.completed - self.started) 
     
+    def matchPoints(self, i, j, w1, w2):
+        ''' Return the points each team gets from the match between teams
+        i < j with w1 and w2 games won or None if not enough games have
+        been played. '''
+        if w1 + w2 < self.fixtures.needed(i, j): return None
+        if w1 > w2: return 2, 0
+        if w1 < w2: return 0, 2
+        return 1, 1
+
+    def tally(self, i, j, winner, loser):
+        ''' Update the running totals for a game in the match between
+        teams i < j. '''
+        w1, w2 = self.cross.get(i, j), self.cross.get(j, i)
+        before = self.matchPoints(i, j, w1, w2)
+        if w1 + w2 == 0: self.started += 1
+        self.cross.add(winner, loser)
+        if winner == i: w1 += 1
+        else: w2 += 1
+        after = self.matchPoints(i, j, w1, w2)
+        if before is None and after is not None:
+            self.played[i] += 1
+            self.played[j] += 1
+            self.started -= 1
+            self.completed += 1
+        if before is not None:
+            self.pts[i] -= before[0]
+            self.pts[j] -= before[1]
+        if after is not None:
+            self.pts[i] += after[0]
+            self.pts[j] += after[1]
+        planned = self.fixtures.planned(i, j)
+        self.game_diff[winner][planned] = self.game_diff[winner].get(planned, 0) + 1
+        self.game_diff[loser][planned] = self.game_diff[loser].get(planned, 0) - 1
+
     def record(self, h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, timestamp):
         keyText =  "Game between " + h_name + " of " + h_team + " and " + a_name + " of " + a_team + " in " + self.name + " league at " + venue + " on " + date
         ''' Record a single result trapping some errors'''
+        h = self.fixtures.number.get(h_team)
+        a = self.fixtures.number.get(a_team)
         if h_score == a_score:
             print (keyText, "was recorded as drawn which is not an acceptable result.")
-        elif (h_team < a_team): 
-            key=h_team, a_team
-            if key in self.matches:
-                self.matches[key].append((h_score,a_score))
-                self.games.append((h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, timestamp))
-            else:
-                print (keyText, "was unexpected.")
-        else: 
-            key=a_team, h_team
-            if key in self.matches:
-                self.matches[key].append((a_score, h_score))
-                self.games.append((h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, timestamp))
+            metrics.count("games_rejected", label=self.name)
+        elif h is None or a is None or not self.fixtures.isFixture(min(h, a), max(h, a)):
+            print (keyText, "was unexpected.")
+            metrics.count("games_rejected", label=self.name)
+        else:
+            self.games.append(h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, timestamp)
+            self.tally(min(h, a), max(h, a), *((h, a) if h_score > a_score else (a, h)))
+            self.version += 1
+            metrics.count("games_recorded", label=self.name)
+
+    def standings(self, cross=None):
+        ''' Work out from scratch the matches played, points and games
+        difference of each team from a cross table, by default the
+        league's own. Pass a modified copy to see what would happen if
+        other results were recorded.
+
+        Returns: played, pts, games - lists indexed by team number, the
+                 games difference being exact as for the table
+
+        '''
+        if cross is None: cross = self.cross
+        n = len(self.teams)
+        if cross.numpy:
+            games = numpy.array(self.fixtures.games, dtype=int)
+            if self.fixtures.explicit is None:
+                planned = numpy.minimum.outer(games, games)
+                needed = (planned + 2)//2
+                numpy.fill_diagonal(needed, numpy.iinfo(int).max)
             else:
-                print (keyText, "was unexpected.")
-                
+                planned = numpy.ones((n, n), dtype=int)
+                needed = numpy.full((n, n), numpy.iinfo(int).max)
+                for (i, j), count in self.fixtures.explicit.items():
+                    planned[i, j] = planned[j, i] = count
+                    needed[i, j] = needed[j, i] = (count + 2)//2
+            wins = cross.wins
+            done = wins + wins.T >= needed
+            played = done.sum(axis=1)
+            pts = (done * (2 * (wins > wins.T) + (wins == wins.T))).sum(axis=1)
+            net = wins - wins.T
+            diff = [{} for i in range(n)]
+            for count in numpy.unique(planned):
+                for i, total in enumerate((net * (planned == count)).sum(axis=1)):
+                    if total: diff[i][int(count)] = int(total)
+            return [int(x) for x in played], [int(x) for x in pts], [gamesDifference(d) for d in diff]
+
+        played = [0] * n
+        pts = [0] * n
+        diff = [{} for i in range(n)]
+        for i, j in {(min(i, j), max(i, j)) for i, j in cross.wins}:
+            w1, w2 = cross.get(i, j), cross.get(j, i)
+            count = self.fixtures.planned(i, j)
+            diff[i][count] = diff[i].get(count, 0) + w1 - w2
+            diff[j][count] = diff[j].get(count, 0) + w2 - w1
+            points = self.matchPoints(i, j, w1, w2)
+            if points is not None:
+                played[i] += 1
+                played[j] += 1
+                pts[i] += points[0]
+                pts[j] += points[1]
+        return played, pts, [gamesDifference(d) for d in diff]
+
     def gamesTable(self):
         ''' Produce a table (in json format) showing all the games played in the league. '''
-        tdata = {}
-        tdata['data'] = []
-        rows = tdata['data']
-        rows.append(("Home team","Home name", "Home hcap", "Home score", "Away team","Away name", "Away hcap", "Away score", "Peeling", "Date", "Venue"))
-        for g in self.games:
-            row = g
-            rows.append(row)
-        return json.dumps(tdata)
+        f = io.StringIO()
+        self.writeGamesTable(f)
+        return f.getvalue()
 
-    def reportResults(self):
+    def writeGamesTable(self, f):
+        ''' Write the table of games to a file one row at a time. '''
+        writeJsonRows(f, itertools.chain([("Home team","Home name", "Home hcap", "Home score", "Away team","Away name", "Away hcap", "Away score", "Peeling", "Date", "Venue")], self.games.rows()))
+
+    def reportResults(self, outbox, ledger):
         '''email results to CroquetScores'''
-        # Find those results already reported. The results are in a file
-        # with multiple lines of json as you can't store the matches
-        # structure directly
-        alreadyDone = set()
-        fname = "reports/"+self.name+".json"
-        if Path(fname).is_file():
-            with open(fname) as f:
-                for jsonobj in f:
-                    key, val = json.loads(jsonobj)
-                    alreadyDone.add(tuple(key))
         matches = {}
         for g in self.games:
-            key = (g[9], g[10], g[0], g[4])
+            key = g.key
             if key not in matches: matches[key]=[]
-            if g[3] > g[7]:
-                result = g[1] + " beat " + g[5] + " +" + str(g[3]-g[7]) + (g[8].lower() if g[3] == 26 else "(t)")
+            if g.h_score > g.a_score:
+                result = g.h_name + " beat " + g.a_name + " +" + str(g.h_score-g.a_score) + (g.pa.lower() if g.h_score == 26 else "(t)")
             else:
-                result = g[5] + " beat " + g[1] + " +" + str(g[7]-g[3]) + (g[8].lower() if g[7] == 26 else "(t)")
+                result = g.a_name + " beat " + g.h_name + " +" + str(g.a_score-g.h_score) + (g.pa.lower() if g.a_score == 26 else "(t)")
             matches[key].append(result)
        
-        for key, results in {key:val for key,val in matches.items() if key not in alreadyDone} .items():
+        wanted = [(key, results) for key, results in matches.items() if not ledger.isDone("results", self.name, key)]
+        bodies = resultsTemplate.renderMany(({}, [{"result": result} for result in results]) for key, results in wanted)
+        for (key, results), (html, text) in zip(wanted, bodies):
             subject = "SCF " + self.name + " League " + key[2] + " vs " + key[3] + " at " + key[1] + " on " + key[0]
-            html = "<p>"
-            for result in results:
-                html += result + "<br/>"
-            html += "</p>"
-            html += "<p>Steve Fisher <em>(SCF AC Leagues Manager)</em></p>"
-
-            if sendHtmlMail(self.people["rankings"], subject, html, reportWanted):
-                if reportWanted:
-                    with open(fname,'w') as f:
-                        for key, value in matches.items():
-                            f.write(json.dumps([key,value]))
-                            f.write("\n")
-
-    def reportToOppos(self):
+            message = makeHtmlMail(self.people["rankings"], subject, html, text)
+            if reportWanted:
+                outbox.enqueue([message], "results", self.name, key)
+
+    def reportToOppos(self, outbox, ledger):
         '''email results to opposition and observer'''
-        # Find those results already reported. The results are in a file
-        # with multiple lines of json as you can't store the matches
-        # structure directly
-
-        # Read in set of keys already processed
-        alreadyDone = set()
-        fname = "reports/"+self.name+" oando.json"
-        if Path(fname).is_file():
-            with open(fname) as f:
-                for jsonobj in f:
-                    key = json.loads(jsonobj)
-                    alreadyDone.add(tuple(key))
-                    
         matches = {}
         meta = {}
         for g in self.games:
-            key = (g[9], g[10], g[0], g[4])
-            if key not in alreadyDone:
+            key = g.key
+            if not ledger.isDone("oando", self.name, key):
                 if key not in matches:
                     matches[key]=[]
-                    meta[key]=g[11:]
-                result = list(g[1:4])
-                result.extend(g[5:9])
-                matches[key].append(tuple(result))
+                    meta[key]=(g.reporter, g.witness, g.timestamp)
+                matches[key].append({"home": g.h_team, "h_name": g.h_name, "h_handicap": g.h_handicap, "h_score": g.h_score,
+                                     "away": g.a_team, "a_name": g.a_name, "a_handicap": g.a_handicap, "a_score": g.a_score, "pa": g.pa})
             
         for key, results in matches.items():
             report,witness,ts = meta[key]
-
-            resultHtml = "<table><tr><th>Home</th><th>Name</th><th>Handicap</th><th>Hoops</th>"
-            resultHtml += "<th>Away</th><th>Name</th><th>Handicap</th><th>Hoops</th><th>Code<th></tr>"
-            for result in results:
-                resultHtml += "<tr><td>" + key[2] + "</td><td>" + result[0] + "</td><td>" + result[1] + "</td><td>" + str(result[2]) + "</td>"
-                resultHtml += "<td>" + key[3] + "</td><td>" + result[3] + "</td><td>" + result[4] + "</td><td>" + str(result[5]) + "</td><td>" + result[6] + "</td></tr>"
-            resultHtml += "</table>"
-
+            ts1, ts2 = ts.split(" ")
+            values = {"reporter": report, "witness": witness, "observer": self.people["observer"], "day": ts1, "time": ts2,
+                      "table": resultsTableTemplate.render({}, results)}
             subject = "SCF " + self.name + " League " + key[2] + " vs " + key[3] + " at " + key[1] + " on " + key[0]
 
-            html = "<p>" + witness + ",</p>"
-            ts1, ts2 = ts.split(" ")
-            html += "<p>The results below were reported by " + report + " on " + ts1 + " at " + ts2 +  "</p><p>"
-            html += resultHtml + "</p>"
-            html += "<p>The results will be visible at https://southern-croquet.org.uk/blog/category/leagues/ within about 15 minutes.</p>"
-            html += "<p>Please report any disagreements.</p>"
-            html += "<p>Steve Fisher <em>(SCF AC Leagues Manager)</em></p>"
- 
-            if sendHtmlMail([report,witness], subject, html, mailWanted):
-                html = "<p>" + self.people["observer"] + ",</p>"
-                html += "<p>The results below were reported by " + report + " on " + ts1 + " at " + ts2
-                html += " and have just been sent to " + witness + " in case they wish to complain. </p><p>"
-                html += resultHtml + "</p>"
-                html += "<p>Steve Fisher <em>(SCF AC Leagues Manager)</em></p>"
-                if sendHtmlMail(self.people["observer"], subject, html, mailWanted):
-                    if mailWanted:
-                        with open(fname,'a') as f:
-                            f.write(json.dumps(key))
-                            f.write("\n")
+            message = makeHtmlMail([report,witness], subject, *opposTemplate.render(values))
+            observerMessage = makeHtmlMail(self.people["observer"], subject, *observerTemplate.render(values))
+            if mailWanted:
+                # The observer is only told once the opponents have been sent it
+                outbox.enqueue([message, observerMessage], "oando", self.name, key)
                
     def table(self):
         ''' Produce a league table (in json format). '''
-        tdata = {}
-        tdata['data'] = []
-        rows = tdata['data']
-        
-        row = []
-        rows.append(row)
-        row.append("Team")
-        for c1,g1 in self.captainGames:
-            row.append(c1.team)
+        f = io.StringIO()
+        self.writeTable(f)
+        return f.getvalue()
+
+    def writeTable(self, f):
+        ''' Write the league table to a file one row at a time. '''
+        writeJsonRows(f, self.tableRows())
+
+    def tableRows(self):
+        ''' Generate the rows of the league table. '''
+        row = ["Team"]
+        row.extend(self.teams)
         row.extend(["Played","Pts","games"])
+        yield row
         
-        for c1,g1 in self.captainGames:
-            played = 0
-            pts = 0
-            games = 0
-            row = []
-            rows.append(row)
-            row.append(c1.team)
-            for c2,g2 in self.captainGames:
-                c1score = 0
-                c2score = 0
-                if c1.team < c2.team:
-                    matches = self.matches[c1.team, c2.team]
-                    for res in matches:
-                        if res[0] > res[1]:
-                            c1score += 1
-                            games += 1/self.planned_game_count[c1.team, c2.team]
-                        else:
-                            c2score += 1
-                            games -= 1/self.planned_game_count[c1.team, c2.team]
-                    row.append(str(c1score) +"-"+ str(c2score))
-                    if len(matches) >= self.min_game_count[c1.team, c2.team]:
-                        played += 1
-                        if c1score > c2score: pts +=2
-                        elif c1score == c2score: pts +=1
-                elif c1.team > c2.team:
-                    matches = self.matches[c2.team, c1.team]
-                    for res in matches:
-                        if res[0] > res[1]:
-                            c2score += 1
-                            games -= 1/self.planned_game_count[c2.team, c1.team]
-                        else:
-                            c1score += 1
-                            games += 1/self.planned_game_count[c2.team, c1.team]
-                    row.append(str(c1score) +"-"+ str(c2score))
-                    if len(matches) >= self.min_game_count[c2.team, c1.team]:
-                        played += 1
-                        if c1score > c2score: pts +=2
-                        elif c1score == c2score: pts +=1
-                else: row.append("")
-            row.append(str(played)) 
-            row.append(str(pts))
-            row.append(str(round(games,2)))
-        
-        return json.dumps(tdata)
+        for i, team in enumerate(self.teams):
+            row = [team]
+            for j in range(len(self.teams)):
+                if i == j: row.append("")
+                else: row.append(str(self.cross.get(i, j)) +"-"+ str(self.cross.get(j, i)))
+            row.append(str(self.played[i])) 
+            row.append(str(self.pts[i]))
+            row.append(str(round(float(gamesDifference(self.game_diff[i])),2)) if self.game_diff[i] else "0")
+            yield row
+
+def gamesDifference(net):
+    ''' Return the exact games difference from a dictionary of net wins
+    by the number of games planned in the match, each game counting
+    1/planned. '''
+    return sum((Fraction(wins, planned) for planned, wins in net.items()), Fraction(0))
+
+def writeJsonRows(f, rows):
+    ''' Write rows to a file in the same form as json.dumps({'data': rows})
+    without holding them all in memory. '''
+    encode = jsonEncoder.encode
+    f.write('{"data": [')
+    for i, row in enumerate(rows):
+        f.write(', ' + encode(row) if i else encode(row))
+    f.write(']}')
+
+# Made once rather than by each json.dumps call
+jsonEncoder = json.JSONEncoder()
+
+class HashingFile:
+    ''' Wrap a text file to work out the sha1 digest of what is written.
+    With no file the text is only hashed. '''
+    def __init__(self, f=None):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, text):
+        self.sha1.update(text.encode())
+        if self.f is None: return len(text)
+        return self.f.write(text)
+
+def writeAtomically(fname, write, manifest=None):
+    ''' Call write with a file handle for a temporary file which then
+    replaces fname, so that a reader never sees it half written. If a
+    manifest of content digests is given the content is first only
+    hashed, and if it has not changed the file is left alone and nothing
+    is written.
+
+    Returns: True if fname was written
+
+    '''
+    if manifest is not None and Path(fname).name in manifest and os.path.exists(fname):
+        hf = HashingFile()
+        write(hf)
+        if manifest[Path(fname).name] == hf.sha1.hexdigest(): return False
+    tmp = fname + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            hf = HashingFile(f)
+            write(hf)
+        digest = hf.sha1.hexdigest()
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    if manifest is not None: manifest[Path(fname).name] = digest
+    return True
+
+def readManifest(fname):
+    ''' Return the dictionary of digests stored in a json file or an empty
+    one if there is no such file. '''
+    if Path(fname).is_file():
+        with open(fname) as f:
+            return json.load(f)
+    return {}
+
+def saveManifest(fname, manifest):
+    ''' Store a dictionary of digests in a json file. '''
+    writeAtomically(fname, lambda f: f.write(json.dumps(manifest, indent=1, sort_keys=True)))
+
+def publishTables(dest, directory="tables"):
+    ''' Copy to dest those tables that differ from the last ones copied
+    there. The dest may be a local directory or anything scp accepts.
+    What was copied to each dest is remembered in the directory's
+    .published.json file, which scp does not pick up with tables/*.
+
+    Returns: the names of the files copied
+
+    '''
+    fname = os.path.join(directory, ".published.json")
+    published = readManifest(fname)
+    done = published.setdefault(dest, {})
+    current = readManifest(os.path.join(directory, ".manifest.json"))
+    names = sorted(name for name, digest in current.items() if done.get(name) != digest and os.path.exists(os.path.join(directory, name)))
+    if names:
+        paths = [os.path.join(directory, name) for name in names]
+        if os.path.isdir(dest):
+            for path, name in zip(paths, names):
+                shutil.copyfile(path, os.path.join(dest, name + ".tmp"))
+                os.replace(os.path.join(dest, name + ".tmp"), os.path.join(dest, name))
+        else:
+            subprocess.run(["scp"] + paths + [dest], check=True)
+        for name in names: done[name] = current[name]
+        saveManifest(fname, published)
+    return names
+
+# The label given to each metric that is broken down, e.g. by league
+metricLabels = {"stage": "stage", "games": "league", "games_recorded": "league", "games_rejected": "league", "table_bytes": "file", "emails": "status"}
+
+class Metrics:
+    ''' Counts and timings gathered during a run, such as the wall time
+    of each stage, for saving as json or in the Prometheus text format.
+    A metric may be broken down by a label, e.g. the games recorded in
+    each league. Timings keep the count, total and longest. If a stage
+    is to be profiled cProfile is run whenever that stage is. '''
+    def __init__(self, profileStage=None):
+        self.counts = {}
+        self.timings = {}
+        self.profileStage = profileStage
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1, label=None):
+        ''' Add n to a count. '''
+        with self.lock:
+            self.counts[name, label] = self.counts.get((name, label), 0) + n
+
+    def set(self, name, value, label=None):
+        ''' Set a count outright. '''
+        with self.lock:
+            self.counts[name, label] = value
+
+    def time(self, name, seconds, label=None):
+        ''' Add one timing. '''
+        with self.lock:
+            count, total, longest = self.timings.get((name, label), (0, 0.0, 0.0))
+            self.timings[name, label] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Time a stage of the run, profiling it if wanted. '''
+        profiling = name == self.profileStage
+        if profiling:
+            if self.profiler is None: self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.time("stage", time.perf_counter() - start, name)
+            if profiling: self.profiler.disable()
+
+    def asDict(self):
+        ''' Return the metrics as a dictionary that can be stored as json,
+        with those broken down by label holding a dictionary by label. '''
+        result = {"counts": {}, "timings": {}}
+        for kind, items in (("counts", self.counts.items()), ("timings", ((key, {"count": c, "seconds": t, "max": m}) for key, (c, t, m) in self.timings.items()))):
+            for (name, label), value in sorted(items, key=lambda item: (item[0][0], str(item[0][1]))):
+                if label is None: result[kind][name] = value
+                else: result[kind].setdefault(name, {})[label] = value
+        return result
+
+    def prometheus(self):
+        ''' Return the metrics in the Prometheus text format. Each timing
+        is a summary of its count and total, with the longest as a gauge
+        family of its own. '''
+        def labelled(name, metric, label):
+            if label is None: return "scf_" + name
+            return "scf_" + name + '{' + metricLabels.get(metric, "label") + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"}'
+        def samples(items, name):
+            return [(label, value) for (n, label), value in sorted(items, key=lambda item: str(item[0][1])) if n == name]
+        lines = []
+        for name in sorted({name for name, label in self.counts}):
+            lines.append("# TYPE scf_" + name + " gauge")
+            for label, value in samples(self.counts.items(), name):
+                lines.append(labelled(name, name, label) + " " + str(value))
+        for name in sorted({name for name, label in self.timings}):
+            lines.append("# TYPE scf_" + name + "_seconds summary")
+            for label, (count, total, longest) in samples(self.timings.items(), name):
+                lines.append(labelled(name + "_seconds_sum", name, label) + " " + repr(total))
+                lines.append(labelled(name + "_seconds_count", name, label) + " " + str(count))
+            lines.append("# TYPE scf_" + name + "_seconds_max gauge")
+            for label, (count, total, longest) in samples(self.timings.items(), name):
+                lines.append(labelled(name + "_seconds_max", name, label) + " " + repr(longest))
+        return "\n".join(lines) + "\n"
+
+    def save(self, fname):
+        ''' Write the metrics to a file, in the Prometheus text format if
+        its name ends in .prom and otherwise as json. '''
+        if str(fname).endswith(".prom"):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.asDict(), indent=1)
+        writeAtomically(str(fname), lambda f: f.write(text))
+
+    def dumpProfile(self, fname):
+        ''' Write the profile of the chosen stage, if it has run, for
+        reading with pstats. '''
+        if self.profiler is not None: self.profiler.dump_stats(str(fname))
+
+metrics = Metrics()
+
+# Changed whenever the League layout changes so old checkpoints are ignored
+checkpointVersion = 10
 
 def readConfig(configFile):
     ''' A config file has one section "files" to identify: corrections,
-    results and captains. This reads it in.
+    results and captains along with an optional fixtures file. This
+    reads it in.
     '''
    
     config=configparser.ConfigParser()
@@ -249,35 +673,123 @@ def readConfig(configFile):
     corrections = config.get("files","corrections")
     results = config.get("files", "results")
     captains = config.get("files", "captains")
+    fixtures = config.get("files", "fixtures", fallback=None)
     people = {}
     people["rankings"] = config.get("people","rankings")
     people["observer"] = config.get("people", "observer")               
     
-    return captains, results, corrections, people
+    return captains, results, corrections, people, fixtures
+
+# The fields of a results row that a correction may change
+correctionFields = frozenset(["Email address", "Email of opponents captain","League","Date","Venue","Home team","Away team","Home player name 1","Home player handicap 1","Home player hoops scored 1","Away player name 1","Away player handicap 1","Away player hoops scored 1","Peeling abbreviation 1","Home player name 2","Home player handicap 2","Home player hoops scored 2","Away player name 2","Away player handicap 2","Away player hoops scored 2","Peeling abbreviation 2","Home player name 3","Home player handicap 3","Home player hoops scored 3","Away player name 3","Away player handicap 3","Away player hoops scored 3","Peeling abbreviation 3","Home player name 4","Home player handicap 4","Home player hoops scored 4","Away player name 4","Away player handicap 4","Away player hoops scored 4","Peeling abbreviation 4"])
+
+def canonicalTimestamp(ts):
+    ''' Return a timestamp in the zero padded dd/mm/yyyy hh:mm:ss form
+    used as the key of the corrections. Anything of that length must
+    already be in that form so only shorter ones need to be parsed. '''
+    if len(ts) == 19: return ts
+    return datetime.strptime(ts,"%d/%m/%Y %H:%M:%S").strftime("%d/%m/%Y %H:%M:%S")
 
-def getCordict(corrections):
+def getCordict(corrections, directory="checkpoints"):
     ''' Read the corrections file and return a dictionary indexed by
-    timestamp. In the event of problems they are reported but the
-    program continues. '''
-    
+    canonical timestamp holding the op and a dictionary of updates. In
+    the event of problems they are reported but the program continues.
+    The result is cached in the given directory and only worked
+    out again when the file's size or modification time changes, though
+    any problems are still reported. '''
+
+    stat = os.stat(corrections)
+    fname = os.path.join(directory, Path(corrections).name + ".pickle")
+    if Path(fname).is_file():
+        with open(fname, 'rb') as f:
+            cache = pickle.load(f)
+        if cache["path"] == os.path.abspath(corrections) and cache["stat"] == (stat.st_size, stat.st_mtime_ns):
+            for problem in cache["problems"]: print (*problem)
+            return dict(cache["cordict"])
+
     cordict = {}
+    problems = []
     with open(corrections) as clist:
         for jsonobj in clist:
             if len(jsonobj.strip()) != 0:
                 try:
                     cor = json.loads("{" + jsonobj + "}")
-                except:
-                    print ("Failed to process", jsonobj)
-                ts = datetime.strptime(cor["ts"],"%d/%m/%Y %H:%M:%S")
+                    ts = canonicalTimestamp(cor["ts"])
+                except (ValueError, KeyError):
+                    problems.append(("Failed to process", jsonobj))
+                    continue
                 if ts in cordict:
-                    print ("Corrections file has multiple occurences of timestamp", ts)
+                    problems.append(("Corrections file has multiple occurences of timestamp", ts))
                 else:
                     for key in cor.keys():
-                    	if key not in ["ts","op","Email address", "Email of opponents captain","League","Date","Venue","Home team","Away team","Home player name 1","Home player handicap 1","Home player hoops scored 1","Away player name 1","Away player handicap 1","Away player hoops scored 1","Peeling abbreviation 1","Home player name 2","Home player handicap 2","Home player hoops scored 2","Away player name 2","Away player handicap 2","Away player hoops scored 2","Peeling abbreviation 2","Home player name 3","Home player handicap 3","Home player hoops scored 3","Away player name 3","Away player handicap 3","Away player hoops scored 3","Peeling abbreviation 3","Home player name 4","Home player handicap 4","Home player hoops scored 4","Away player name 4","Away player handicap 4","Away player hoops scored 4","Peeling abbreviation 4"]:
-                    	    print("Unexpected field", key, "in", jsonobj)
-                    cordict[ts] = {key:val for key,val in cor.items() if key != 'ts'}
+                        if key not in correctionFields and key not in ("ts", "op"):
+                            problems.append(("Unexpected field", key, "in", jsonobj))
+                    cordict[ts] = (cor.get("op"), {key:val for key,val in cor.items() if key not in ("ts", "op")})
+    for problem in problems: print (*problem)
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    with open(fname + ".tmp", 'wb') as f:
+        pickle.dump({"path": os.path.abspath(corrections), "stat": (stat.st_size, stat.st_mtime_ns), "problems": problems, "cordict": cordict}, f)
+    os.replace(fname + ".tmp", fname)
     return cordict
 
+def correctRow(row, cordict):
+    ''' Apply any correction for this row, removing it from cordict.
+
+    Returns: the corrected row or None if the row has been deleted
+
+    '''
+    ts = canonicalTimestamp(row['Timestamp'])
+    if ts in cordict:
+        op, updates = cordict.pop(ts)
+        if op == "update":
+            metrics.count("corrections_applied")
+            for key, val in updates.items():
+                row[key]=val
+        elif op == "delete":
+            metrics.count("corrections_applied")
+            return None
+        else:
+            print ("Unexpected correction op", op)
+    return row
+
+def ingestRows(reader, cordict, data, keycount):
+    ''' Correct rows and add them to data which is indexed by league,
+    date, venue, home_team and away_team. The number of times each key
+    has been seen is kept in keycount and any key seen more than once is
+    removed from data.
+
+    Returns: added - keys added to data
+             dropped - keys removed from data as duplicates
+
+    '''
+    added = []
+    dropped = set()
+    for row in reader:
+        metrics.count("rows_read")
+        row = correctRow(row, cordict)
+        if row is None: continue
+
+        home_team = row['Home team']
+        away_team = row['Away team']
+        league = row['League']
+        date = row['Date']
+        venue = row['Venue']
+        key = (league, date, venue, home_team, away_team)
+        if key not in keycount:
+            data[key] = row
+            keycount[key] = 1
+            added.append(key)
+        else:
+            if keycount[key] == 1:
+                print ("Duplicate results for ",key, "submitted by", row['Email address'], "and", data[key]['Email address'])
+                # Only keep data reported once
+                del data[key]
+                dropped.add(key)
+            keycount[key] += 1
+    metrics.count("duplicates_dropped", len(dropped))
+    return added, dropped
+
 def readResults(results, cordict):
     ''' Read and correct the results. Each result record has a key of
     league, date, venue, home_team and away_team. If a game has been
@@ -292,143 +804,1247 @@ def readResults(results, cordict):
 
         data = {}
         keycount = {}
-  
-        for row in reader:
-            ts = datetime.strptime(row['Timestamp'],"%d/%m/%Y %H:%M:%S")
-            
-            if ts in cordict:
-                op = cordict[ts]['op']
-                if op == "update":
-                    updates = {key:val for key,val in cordict[datetime.strptime(row['Timestamp'],"%d/%m/%Y %H:%M:%S")].items() if key != 'op'}
-                    for key, val in updates.items():
-                        row[key]=val
-                    del cordict[ts]
-                elif op == "delete":
-                    del cordict[ts]
-                    continue
-                else:
-                    print ("Unexpected correction op", op)
-                    del cordict[ts]
-                
-            home_team = row['Home team']
-            away_team = row['Away team']
-            league = row['League']
-            date = row['Date']
-            venue = row['Venue']
-            key = (league, date, venue, home_team, away_team)
-            if key not in data:
-                data[key] = row
-                keycount[key] = 1
-            else:
-                if keycount[key] == 1:
-                    keycount[key] = 2
-                    print ("Duplicate results for ",key, "submitted by", row['Email address'], "and", data[key]['Email address'])
-                else:
-                    keycount[key] += 1
-                    
-    # Only keep data reported once
-    for multi in {key: val for key, val in keycount.items() if val > 1 }.keys():
-        del data[multi]
-  
+        ingestRows(reader, cordict, data, keycount)
+
     # Report other problems
     if cordict: print("Some corrections have not been applied", cordict)              
+    metrics.set("corrections_unapplied", len(cordict))
 
     return data.values()
 
-def getLeagues(captains, people):
+def fileDigest(fname):
+    ''' Return the sha1 hex digest of a file's contents. '''
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def readIncremental(configFile, captains, results, corrections, people, useNumpy=False, fixtures=None, directory="checkpoints"):
+    ''' Bring the leagues up to date using the checkpoint saved by the
+    previous run, reading only those responses appended to the results
+    file since then. The checkpoint holds the corrected data, the
+    duplicate counts, the unapplied corrections and the populated
+    leagues along with the byte offset reached in the results file. A
+    full rebuild is done if the corrections or captains file has changed
+    or if the part of the results file already read is not as it was.
+    The same happens if the fixtures file has changed or the checkpoint
+    was written by a different version of this program.
+
+    Returns: leagues - an array of Leagues indexed by name
+
+    '''
+    fname = os.path.join(directory, Path(configFile).name + ".pickle")
+    state = None
+    if Path(fname).is_file():
+        with open(fname, 'rb') as f:
+            state = pickle.load(f)
+    state = updateIncremental(state, captains, results, corrections, people, useNumpy, fixtures, directory)
+    saveCheckpoint(fname, state)
+    return state["leagues"]
+
+def saveCheckpoint(fname, state):
+    ''' Store the state used by readIncremental. '''
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname + ".tmp", 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(fname + ".tmp", fname)
+
+def updateIncremental(state, captains, results, corrections, people, useNumpy=False, fixtures=None, directory="checkpoints"):
+    ''' Apply the responses added to the results file since the state was
+    saved, or start afresh if state is None or out of date, as described
+    for readIncremental.
+
+    Returns: state - the updated state
+
+    '''
+    sig = (checkpointVersion, fileDigest(corrections), fileDigest(captains), fixtures and fileDigest(fixtures))
+    if state is not None and state["sig"] != sig: state = None
+
+    with open(results, 'rb') as f:
+        raw = f.read()
+
+    if state is not None:
+        offset = state["offset"]
+        if len(raw) < offset or hashlib.sha1(raw[:offset]).hexdigest() != state["digest"]:
+            state = None
+
+    fresh = state is None
+    if fresh:
+        state = {"sig": sig, "offset": 0, "digest": hashlib.sha1().hexdigest(), "timestamp": None, "header": None,
+                 "cordict": getCordict(corrections, directory), "data": {}, "keycount": {}, "leagues": None}
+
+    # Only take complete lines so a partly written file is picked up next time
+    offset = state["offset"]
+    end = raw.rfind(b"\n", offset) + 1
+    if end == 0: end = offset
+    text = raw[offset:end].decode("utf-8")
+    reader = csv.DictReader(io.StringIO(text, newline=''), fieldnames=state["header"])
+    rows = []
+    for row in reader:
+        rows.append(row)
+    if state["header"] is None: state["header"] = reader.fieldnames
+    since = state["timestamp"]
+    if rows: state["timestamp"] = rows[-1]["Timestamp"]
+
+    data = state["data"]
+    added, dropped = ingestRows(rows, state["cordict"], data, state["keycount"])
+    if fresh or not dropped.issubset(added):
+        # A match already in the leagues has been reported again
+        leagues = getLeagues(captains, people, useNumpy, fixtures)
+        populateLeagues(data.values(), leagues)
+    else:
+        leagues = state["leagues"]
+        for league in leagues.values(): league.people = people
+        populateLeagues([data[key] for key in added if key in data], leagues)
+
+    if state["cordict"]: print("Some corrections have not been applied", state["cordict"])
+    metrics.set("corrections_unapplied", len(state["cordict"]))
+    print("Read", len(rows), "new responses" + ("" if fresh else " since " + str(since)))
+
+    state["leagues"] = leagues
+    state["offset"] = end
+    state["digest"] = hashlib.sha1(raw[:end]).hexdigest()
+    return state
+
+# Changed whenever the database layout changes so old databases are rebuilt
+databaseVersion = 2
+
+def openDatabase(fname):
+    ''' Open (creating if need be) an SQLite database that holds the
+    responses, their games, the corrections and the captains of any
+    number of seasons. Each game is a row of its own with a column for
+    each value, indexed by league and teams, so that standings can be
+    worked out by query. A database of another layout is emptied to be
+    loaded again from the files. '''
+    db = sqlite3.connect(fname, timeout=60)
+    if db.execute("PRAGMA user_version").fetchone()[0] != databaseVersion:
+        with db:
+            for table, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                db.execute('DROP TABLE "' + table + '"')
+        db.execute("PRAGMA user_version = " + str(databaseVersion))
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS sources (season, kind, path, digest, PRIMARY KEY (season, kind));
+        CREATE TABLE IF NOT EXISTS responses (season, row INTEGER, Timestamp, league, date, venue, home_team, away_team, email, PRIMARY KEY (season, row));
+        CREATE INDEX IF NOT EXISTS responses_key ON responses (season, league, date, venue, home_team, away_team);
+        CREATE INDEX IF NOT EXISTS responses_ts ON responses (season, Timestamp);
+        CREATE TABLE IF NOT EXISTS games (season, row INTEGER, game INTEGER, league, h_team, h_name, h_handicap, h_score INTEGER, a_team, a_name, a_handicap, a_score INTEGER,
+            pa, date, venue, reporter, witness, Timestamp, PRIMARY KEY (season, row, game));
+        CREATE INDEX IF NOT EXISTS games_league ON games (season, league, h_team, a_team);
+        CREATE TABLE IF NOT EXISTS corrections (season, Timestamp, op, updates, applied, PRIMARY KEY (season, Timestamp));
+        CREATE TABLE IF NOT EXISTS captains (season, club, given, surname, email, league, games);
+        CREATE INDEX IF NOT EXISTS captains_league ON captains (season, league);
+    ''')
+    return db
+
+def ingestSeason(db, season, captains, results, corrections, directory="checkpoints"):
+    ''' Load a season's files into the database. The responses and their
+    games are stored with their corrections applied, deleted ones being
+    left out. Files
+    that have not changed since they were last loaded are skipped. The
+    parsed corrections are cached in the given directory. '''
+    digests = {"captains": fileDigest(captains), "results": fileDigest(results), "corrections": fileDigest(corrections)}
+    stored = dict(db.execute("SELECT kind, digest FROM sources WHERE season = ?", (season,)))
+    with db:
+        if stored.get("results") != digests["results"] or stored.get("corrections") != digests["corrections"]:
+            cordict = getCordict(corrections, directory)
+            db.execute("DELETE FROM responses WHERE season = ?", (season,))
+            db.execute("DELETE FROM games WHERE season = ?", (season,))
+            db.execute("DELETE FROM corrections WHERE season = ?", (season,))
+            db.executemany("INSERT INTO corrections VALUES (?,?,?,?,0)", ((season, ts, op, json.dumps(updates)) for ts, (op, updates) in cordict.items()))
+            with open(results, newline='') as csvfile:
+                reader = csv.DictReader(csvfile)
+                for i, row in enumerate(reader):
+                    metrics.count("rows_read")
+                    ts = canonicalTimestamp(row['Timestamp'])
+                    row = correctRow(row, cordict)
+                    if row is None: continue
+                    db.execute("INSERT INTO responses VALUES (?,?,?,?,?,?,?,?,?)", (season, i, ts, row['League'], row['Date'], row['Venue'], row['Home team'], row['Away team'], row['Email address']))
+                    db.executemany("INSERT INTO games VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", ((season, i, game, row['League']) + values for game, values in enumerate(gameValues(row))))
+            db.execute("UPDATE corrections SET applied = 1 WHERE season = ?", (season,))
+            db.executemany("UPDATE corrections SET applied = 0 WHERE season = ? AND Timestamp = ?", ((season, ts) for ts in cordict))
+        if stored.get("captains") != digests["captains"]:
+            db.execute("DELETE FROM captains WHERE season = ?", (season,))
+            db.executemany("INSERT INTO captains VALUES (?,?,?,?,?,?,?)", ((season, c.team, c.given, c.surname, c.email, name, games) for c, name, games in readCaptains(captains)))
+        for kind, path in (("captains", captains), ("results", results), ("corrections", corrections)):
+            db.execute("INSERT OR REPLACE INTO sources VALUES (?,?,?,?)", (season, kind, path, digests[kind]))
+
+def readResultsFromDb(db, season):
+    ''' As readResults but taking a season's responses from the database,
+    reporting the duplicates and the corrections not applied.
+
+    Returns: games - the league and values of each game of the good
+             responses, as taken by recordGames
+
+    '''
+    for key in db.execute('''
+            SELECT league, date, venue, home_team, away_team FROM responses r WHERE season = ?
+            GROUP BY league, date, venue, home_team, away_team HAVING COUNT(*) > 1
+            ORDER BY (SELECT row FROM responses d WHERE d.season = r.season AND d.league = r.league AND d.date = r.date
+                      AND d.venue = r.venue AND d.home_team = r.home_team AND d.away_team = r.away_team ORDER BY row LIMIT 1 OFFSET 1)''', (season,)).fetchall():
+        first, second = [email for email, in db.execute(
+            "SELECT email FROM responses WHERE season = ? AND league = ? AND date = ? AND venue = ? AND home_team = ? AND away_team = ? ORDER BY row LIMIT 2", (season,) + key)]
+        print ("Duplicate results for ",key, "submitted by", second, "and", first)
+        metrics.count("duplicates_dropped")
+
+    games = db.execute('''
+        SELECT league, h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, Timestamp
+        FROM games WHERE season = ? AND row IN (SELECT row FROM responses r WHERE season = ? AND NOT EXISTS
+            (SELECT 1 FROM responses d WHERE d.season = r.season AND d.league = r.league AND d.date = r.date
+             AND d.venue = r.venue AND d.home_team = r.home_team AND d.away_team = r.away_team AND d.row != r.row))
+        ORDER BY row, game''', (season, season)).fetchall()
+
+    unapplied = {ts: (op, json.loads(updates)) for ts, op, updates in db.execute("SELECT Timestamp, op, updates FROM corrections WHERE season = ? AND applied = 0", (season,))}
+    if unapplied: print("Some corrections have not been applied", unapplied)
+    metrics.set("corrections_applied", db.execute("SELECT COUNT(*) FROM corrections WHERE season = ? AND applied = 1", (season,)).fetchone()[0])
+    metrics.set("corrections_unapplied", len(unapplied))
+
+    return games
+
+def getLeaguesFromDb(db, season, people, useNumpy=False, fixtures=None, strings=None):
+    ''' As getLeagues but taking a season's captains from the database. '''
+    rows = db.execute("SELECT club, given, surname, email, league, games FROM captains WHERE season = ? ORDER BY rowid", (season,))
+    return makeLeagues(((Captain(club, given, surname, email), league, games) for club, given, surname, email, league, games in rows), people, useNumpy, fixtures, strings)
+
+def getLeagues(captains, people, useNumpy=False, fixtures=None, strings=None):
     ''' Derive an array of leagues indexed by name from the captains csv
-    file.
+    file. If there is a fixtures csv file, with columns League, Home
+    team, Away team and Games, the leagues it mentions only have the
+    matches it lists rather than every team playing every other. The
+    leagues share one StringTable for their games, which may be passed in
+    to share it with other seasons.
 
     Returns: leagues - an array of Leagues indexed by name
 
     '''   
-    A = set()
-    B = set()
-    C = set()
-    HN = set()
-    HS = set()
-    leagues = {}
-    names = ['A Level','B Level','C Level','Hcap N','Hcap S']
-    ls = [A,B,C,HN,HS]
+    return makeLeagues(readCaptains(captains), people, useNumpy, fixtures, strings)
+
+# The leagues in the order they are processed
+leagueNames = ['A Level','B Level','C Level','Hcap N','Hcap S']
+
+def readCaptains(captains):
+    ''' Generate (captain, league name, number of games) for each league
+    entered by each club in the captains csv file. '''
     with open(captains, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             captain = Captain(row['Club'], row['Given'], row['Surname'], row['Email'])
-            for name,league in zip(names,ls):
-            	if int(row[name]) > 1: league.add((captain,int(row[name])))
+            for name in leagueNames:
+                if int(row[name]) > 1: yield captain, name, int(row[name])
 
-    for name,league in zip(names,ls):
-        leagues[name] = League(name, league, people)
+def makeLeagues(entries, people, useNumpy=False, fixtures=None, strings=None):
+    ''' Make the leagues from (captain, league name, number of games)
+    entries as for getLeagues. '''
+    leagues = {}
+    ls = {name: set() for name in leagueNames}
+    for captain, name, games in entries:
+        ls[name].add((captain, games))
+
+    fixtureLists = {}
+    if fixtures is not None:
+        with open(fixtures, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                if row['League'] not in fixtureLists: fixtureLists[row['League']] = []
+                fixtureLists[row['League']].append((row['Home team'], row['Away team'], int(row['Games'])))
+
+    if strings is None: strings = StringTable()
+    for name in leagueNames:
+        leagues[name] = League(name, ls[name], people, useNumpy, fixtureLists.get(name), strings)
     return leagues
 
+def gameValues(datum):
+    '''Generate the values of each game in a results row in the order
+    taken by League.record.'''
+    date = datum["Date"]
+    venue = datum["Venue"]
+    h_team = datum["Home team"]
+    a_team = datum["Away team"]
+    reporter = datum["Email address"]
+    witness = datum["Email of opponents captain"]
+    ts = datum["Timestamp"]
+    for i in range(1,5):
+        if len(datum['Home player hoops scored ' + str(i)].strip()) == 0: break
+        h_score = int(datum['Home player hoops scored ' + str(i)])
+        a_score = int(datum['Away player hoops scored ' + str(i)])
+        h_name = datum['Home player name ' + str(i)]
+        a_name = datum['Away player name ' + str(i)]
+        h_handicap = datum['Home player handicap ' + str(i)]
+        a_handicap = datum['Away player handicap ' + str(i)]
+        pa = datum['Peeling abbreviation ' + str(i)]
+        yield h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, ts
+
 def populateLeagues(data, leagues):
-    '''Populate the leagues.'''
+    '''Populate the leagues, checking the players' names against the
+    player index if there is one.'''
     for datum in data:
-        date = datum["Date"]
-        venue = datum["Venue"]
-        league_name = datum["League"]
-        league = leagues[league_name]
-        h_team = datum["Home team"]
-        a_team = datum["Away team"]
-        reporter = datum["Email address"]
-        witness = datum["Email of opponents captain"]
-        ts = datum["Timestamp"]
-        for i in range(1,5):
-            if len(datum['Home player hoops scored ' + str(i)].strip()) == 0: break
-            h_score = int(datum['Home player hoops scored ' + str(i)])
-            a_score = int(datum['Away player hoops scored ' + str(i)])
-            h_name = datum['Home player name ' + str(i)]
-            a_name = datum['Away player name ' + str(i)]
-            h_handicap = datum['Home player handicap ' + str(i)]
-            a_handicap = datum['Away player handicap ' + str(i)]
-            pa = datum['Peeling abbreviation ' + str(i)]
-            league.record(h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, venue, reporter, witness, ts)
-
-def sendHtmlMail(to, subject, html, actionWanted):
-    '''Send an email
+        league = leagues[datum["League"]]
+        for values in gameValues(datum):
+            if playerIndex is not None: checkPlayers(league.name, *values)
+            league.record(*values)
+
+def recordGames(games, leagues):
+    '''Record games given as the league name followed by the values
+    taken by League.record, as populateLeagues does.'''
+    for name, *values in games:
+        league = leagues[name]
+        if playerIndex is not None: checkPlayers(league.name, *values)
+        league.record(*values)
+
+def checkPlayers(league, h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, *rest):
+    '''Report any player in a game who has not played elsewhere but whose
+    name is close to that of one who has.'''
+    for name, team in ((h_name, h_team), (a_name, a_team)):
+        suggestion = playerIndex.suggest(name)
+        if suggestion is not None:
+            print ("Player", name, "of", team, "in", league, "league on", date, "has not been seen in any other game, perhaps", suggestion, "was meant")
+            metrics.count("players_unrecognised")
+
+def normaliseName(name):
+    ''' Return a name in the form used to match players: lower case with
+    full stops dropped and runs of spaces made single. '''
+    return " ".join(name.replace(".", " ").split()).lower()
+
+def parseHandicap(handicap):
+    ''' Return a handicap as a number or NaN if it is not one. '''
+    try:
+        return float(handicap)
+    except ValueError:
+        return float("nan")
+
+class PlayerIndex:
+    ''' Every player's games in a number of seasons, kept in a file that
+    is memory mapped rather than read in. Players are numbered in the
+    order they are first seen and are matched by normalised name, the
+    spelling first seen being the one shown. Each game is held twice,
+    once for each player, as columns of records sorted by player and
+    date, so that the games of a player are a slice found from the
+    offsets column. When a season's results or corrections change only
+    that season is read again. '''
+    version = 1
+    columns = (("player", "I"), ("opponent", "I"), ("season", "I"), ("day", "I"), ("handicap", "f"), ("score", "h"), ("against", "h"))
+
+    def __init__(self, fname="players.idx"):
+        self.fname = str(fname)
+        self.mm = None
+        self.open()
+
+    def open(self):
+        ''' Map the file, if there is one written by this version of the
+        program on a machine of the same byte order. '''
+        self.close()
+        self.header = {"seasons": [], "names": [], "count": 0}
+        self.views = {}
+        mapped = self.map() if Path(self.fname).is_file() else None
+        if mapped is not None: self.mm, self.header, self.views = mapped
+        self.names = self.header["names"]
+        self.ids = {normaliseName(name): i for i, name in enumerate(self.names)}
+        self.seasons = [season for season, digest in self.header["seasons"]]
+        self.suggestions = {}
+
+    def map(self):
+        ''' Return the mmap, header and column views of the file or None
+        if it is empty, cut short or not understood, in which case it is
+        taken as no index and written again. '''
+        with open(self.fname, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped
+                return None
+        view = None
+        views = {}
+        try:
+            length, = struct.unpack_from("<I", mm, 0)
+            header = json.loads(mm[4:4 + length])
+            if header.get("version") == self.version and header.get("byteorder") == sys.byteorder:
+                view = memoryview(mm)
+                for name, (offset, size, code) in header["layout"].items():
+                    if offset + size > len(mm): break
+                    views[name] = view[offset:offset + size].cast(code)
+                else:
+                    return mm, header, views
+        except (struct.error, ValueError, TypeError, KeyError, AttributeError):
+            pass
+        for column in views.values(): column.release()
+        if view is not None: view.release()
+        mm.close()
+        return None
+
+    def close(self):
+        ''' Unmap the file. '''
+        if self.mm is not None:
+            for view in self.views.values(): view.release()
+            self.views = {}
+            self.mm.close()
+            self.mm = None
+
+    def column(self, name):
+        ''' Return a column, which is empty if there are no games. '''
+        return self.views.get(name, array(dict(self.columns + (("offsets", "I"),))[name]))
+
+    def update(self, seasons, directory="checkpoints"):
+        ''' Bring the index up to date with a list of (season, results,
+        corrections) reading again only those seasons whose files have
+        changed or which are new. Seasons not listed are dropped. Any
+        problems with the files are left for the season's own run to
+        report.
+
+        Returns: the names of the seasons read
+
+        '''
+        digests = [(season, fileDigest(results) + fileDigest(corrections)) for season, results, corrections in seasons]
+        if digests == [tuple(pair) for pair in self.header["seasons"]]: return []
+        old = dict(self.header["seasons"])
+        keep = {self.seasons.index(season): i for i, (season, digest) in enumerate(digests) if old.get(season) == digest}
+
+        # Take the games of the unchanged seasons from the old index
+        records = {name: array(code) for name, code in self.columns}
+        season = self.column("season")
+        wanted = [r for r in range(self.header["count"]) if season[r] in keep]
+        for name, code in self.columns:
+            column = self.column(name)
+            records[name].extend(keep[column[r]] if name == "season" else column[r] for r in wanted)
+        names = list(self.names)
+        ids = dict(self.ids)
+        self.close()
+
+        def playerId(name):
+            key = normaliseName(name)
+            if key not in ids:
+                ids[key] = len(names)
+                names.append(name.strip())
+            return ids[key]
+
+        read = []
+        for i, (season, results, corrections) in enumerate(seasons):
+            if i in keep.values(): continue
+            read.append(season)
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = readResults(results, getCordict(corrections, directory))
+            for datum in data:
+                for h_team, h_name, h_handicap, h_score, a_team, a_name, a_handicap, a_score, pa, date, *rest in gameValues(datum):
+                    h, a, day = playerId(h_name), playerId(a_name), parseDate(date)
+                    for values in ((h, a, i, day, parseHandicap(h_handicap), h_score, a_score), (a, h, i, day, parseHandicap(a_handicap), a_score, h_score)):
+                        for (name, code), value in zip(self.columns, values): records[name].append(value)
+
+        # Sort by player, date and season and note where each player starts
+        order = sorted(range(len(records["player"])), key=lambda r: (records["player"][r], records["day"][r], records["season"][r]))
+        for name, code in self.columns: records[name] = array(code, (records[name][r] for r in order))
+        offsets = array("I", [0] * (len(names) + 1))
+        for player in records["player"]: offsets[player + 1] += 1
+        for i in range(len(names)): offsets[i + 1] += offsets[i]
+        records["offsets"] = offsets
+        self.write(digests, names, records)
+        self.open()
+        return read
+
+    def write(self, digests, names, records):
+        ''' Write the index so that it is never seen half written. Each
+        column is aligned on an 8 byte boundary after the json header. '''
+        # Leave room for the header with the layout filled in
+        layout = {name: (2**40, 2**40, column.typecode) for name, column in records.items()}
+        header = {"version": self.version, "byteorder": sys.byteorder, "seasons": digests, "names": names, "count": len(records["player"]), "layout": layout}
+        offset = 4 + len(json.dumps(header).encode())
+        offset += -offset % 8
+        for name, column in records.items():
+            size = len(column) * column.itemsize
+            layout[name] = (offset, size, column.typecode)
+            offset += size + -size % 8
+        text = json.dumps(header).encode()
+        tmp = self.fname + ".tmp"
+        Path(self.fname).parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack("<I", len(text)))
+            f.write(text)
+            for name, column in records.items():
+                f.seek(layout[name][0])
+                column.tofile(f)
+            f.truncate(max(offset, f.tell()))
+            # On disk before the rename, so a crash cannot leave a short file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+
+    def playerId(self, name):
+        ''' Return the number of a player or None if not known. '''
+        return self.ids.get(normaliseName(name))
+
+    def count(self, name):
+        ''' Return the number of games a player has played. '''
+        player = self.playerId(name)
+        if player is None or not self.views: return 0
+        offsets = self.views["offsets"]
+        return offsets[player + 1] - offsets[player]
+
+    def games(self, name):
+        ''' Return a player's games in date order as (season, date,
+        handicap, score, opponent, opponent's score) with the date None if
+        it could not be understood. '''
+        player = self.playerId(name)
+        if player is None or not self.views: return []
+        offsets = self.views["offsets"]
+        columns = [self.views[column] for column in ("season", "day", "handicap", "opponent", "score", "against")]
+        games = []
+        for r in range(offsets[player], offsets[player + 1]):
+            season, day, handicap, opponent, score, against = (column[r] for column in columns)
+            games.append((self.seasons[season], date.fromordinal(day) if day else None, handicap, score, self.names[opponent], against))
+        return games
+
+    def handicaps(self, name):
+        ''' Return a player's handicap history as (date, handicap) for
+        the first game and each game at a new handicap. '''
+        history = []
+        for season, day, handicap, score, opponent, against in self.games(name):
+            if handicap == handicap and (not history or history[-1][1] != handicap): history.append((day, handicap))
+        return history
+
+    def suggest(self, name):
+        ''' If a player has played at most one game, the one being
+        checked, return the name of a player with more games whose name is
+        close or else None. '''
+        key = normaliseName(name)
+        if key not in self.suggestions:
+            suggestion = None
+            if self.count(name) <= 1:
+                for close in difflib.get_close_matches(key, self.ids, n=3, cutoff=0.85):
+                    if close != key and self.count(close) > 1:
+                        suggestion = self.names[self.ids[close]]
+                        break
+            self.suggestions[key] = suggestion
+        return self.suggestions[key]
+
+# The player index used by populateLeagues to check names, if wanted
+playerIndex = None
+
+class MailSession:
+    ''' A connection to the mail server shared by all the emails sent in
+    a run. It logs in when the first message is sent and logs in again
+    only if the server drops the connection. '''
+    def __init__(self, host="mail.southern-croquet.org.uk", port=465, username="ac-leagues-manager@southern-croquet.org.uk", passwordFile="password", useSsl=True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.passwordFile = passwordFile
+        self.useSsl = useSsl
+        self.password = None
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        ''' Open the connection and log in. '''
+        start = time.perf_counter()
+        if self.useSsl:
+            if self.password is None:
+                with open(self.passwordFile) as p:
+                    self.password = p.readline().rstrip("\n")
+            context = ssl.create_default_context()
+            self.server = smtplib.SMTP_SSL(self.host, self.port, context=context)
+            self.server.login(self.username, self.password)
+        else:
+            self.server = smtplib.SMTP(self.host, self.port)
+#       self.server.set_debuglevel(1)
+        metrics.time("smtp_connect", time.perf_counter() - start)
+
+    def close(self):
+        ''' Log out if connected. '''
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.server = None
+
+    def sendmail(self, to, message):
+        ''' Send a message reconnecting once if the connection has been
+        lost.
+
+        Returns: True if all recipients accepted the message
+
+        '''
+        for attempt in range(2):
+            if self.server is None: self.connect()
+            try:
+                start = time.perf_counter()
+                fails = self.server.sendmail(self.username, to, message.as_string())
+                metrics.time("smtp_send", time.perf_counter() - start)
+                break
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+                if attempt == 1: raise
+            except smtplib.SMTPRecipientsRefused as inst:
+                print (inst)
+                return False
+        if len(fails) >0: print (fails)
+        return len(fails) == 0
+
+class MailTemplate:
+    ''' The HTML and plain text versions of an email body, or of part of
+    one, as format strings filled in from the same values. A value may
+    itself be an (html, text) pair rendered by another template. If row
+    templates are given they are filled in from each of a list of values
+    and put where the body has {rows}. The format strings are bound once
+    so that many messages can be rendered quickly. '''
+    def __init__(self, html, text, rowHtml=None, rowText=None):
+        self.html = html.format_map
+        self.text = text.format_map
+        self.rowHtml = rowHtml and rowHtml.format_map
+        self.rowText = rowText and rowText.format_map
+
+    def render(self, values, rows=()):
+        ''' Return the html and text for a dictionary of values and a list
+        of dictionaries of values for the rows. '''
+        htmlValues = {key: val[0] if isinstance(val, tuple) else val for key, val in values.items()}
+        textValues = {key: val[1] if isinstance(val, tuple) else val for key, val in values.items()}
+        if self.rowHtml is not None:
+            htmlValues["rows"] = "".join(map(self.rowHtml, rows))
+            textValues["rows"] = "".join(map(self.rowText, rows))
+        return self.html(htmlValues), self.text(textValues)
+
+    def renderMany(self, items):
+        ''' Return the html and text for each (values, rows) pair. '''
+        return [self.render(values, rows) for values, rows in items]
+
+signature = MailTemplate("<p>Steve Fisher <em>(SCF AC Leagues Manager)</em></p>", "Steve Fisher (SCF AC Leagues Manager)\n\n")
+
+resultsTemplate = MailTemplate("<p>{rows}</p>" + signature.html({}), "{rows}\n" + signature.text({}),
+    "{result}<br/>", "{result}  \n")
+
+resultsTableTemplate = MailTemplate(
+    "<table><tr><th>Home</th><th>Name</th><th>Handicap</th><th>Hoops</th><th>Away</th><th>Name</th><th>Handicap</th><th>Hoops</th><th>Code</th></tr>{rows}</table>",
+    "Home| Name| Handicap| Hoops| Away| Name| Handicap| Hoops| Code  \n---|---|---|---|---|---|---|---|---  \n{rows}",
+    "<tr><td>{home}</td><td>{h_name}</td><td>{h_handicap}</td><td>{h_score}</td><td>{away}</td><td>{a_name}</td><td>{a_handicap}</td><td>{a_score}</td><td>{pa}</td></tr>",
+    "{home}| {h_name}| {h_handicap}| {h_score}| {away}| {a_name}| {a_handicap}| {a_score}| {pa}  \n")
+
+opposTemplate = MailTemplate(
+    "<p>{witness},</p><p>The results below were reported by {reporter} on {day} at {time}</p><p>{table}</p>"
+    "<p>The results will be visible at https://southern-croquet.org.uk/blog/category/leagues/ within about 15 minutes.</p>"
+    "<p>Please report any disagreements.</p>" + signature.html({}),
+    "{witness},\n\nThe results below were reported by {reporter} on {day} at {time}\n\n{table}\n"
+    "The results will be visible at https://southern-croquet.org.uk/blog/category/leagues/ within about 15 minutes.\n\n"
+    "Please report any disagreements.\n\n" + signature.text({}))
+
+observerTemplate = MailTemplate(
+    "<p>{observer},</p><p>The results below were reported by {reporter} on {day} at {time}"
+    " and have just been sent to {witness} in case they wish to complain. </p><p>{table}</p>" + signature.html({}),
+    "{observer},\n\nThe results below were reported by {reporter} on {day} at {time}"
+    " and have just been sent to {witness} in case they wish to complain.\n\n{table}\n" + signature.text({}))
+
+def makeHtmlMail(to, subject, html, text):
+    '''Build an email with HTML and plain text versions of the body,
+    listing it if wanted.
 
     Parameters: to - email of intended recipient
                 subject - subject field
-                text - main body of the message to send as plain text
                 html - main body of the message as HTML
-                '''
+                text - the same as plain text
 
-    username = "ac-leagues-manager@southern-croquet.org.uk"
-    with open("password") as p:
-        password = p.readline().rstrip("\n")
-    sender_email = username
-    text_maker = html2text.HTML2Text()
-    text_maker.ignore_emphasis = True
-    text = text_maker.handle(html)
+    Returns: message - a dictionary that can be stored as json
+                '''
 
     if printWanted:
         print("\nTo: " + str(to) + "\nSubject: " + subject)
         for line in text.split("\n"):
             if line.strip() != "": print(line)
 
-    if actionWanted:
-        message = MIMEMultipart("alternative")
-        message["Subject"] = subject
-        message["From"] = sender_email
-        message["To"] = ",".join(to) if isinstance(to,list) else to
-        message.attach(MIMEText(text, "plain"))
-        message.attach(MIMEText(html, "html"))
-                           
-        context = ssl.create_default_context()
-
-        with smtplib.SMTP_SSL("mail.southern-croquet.org.uk", 465, context=context) as server:
-            server.login(username, password)
-#           server.set_debuglevel(1)
+    return {"to": to, "subject": subject, "html": html, "text": text}
+
+def sendHtmlMail(message, session):
+    '''Send an email made by makeHtmlMail
+
+    Returns: True if all recipients accepted it
+    '''
+    to = message["to"]
+    mime = MIMEMultipart("alternative")
+    mime["Subject"] = message["subject"]
+    mime["From"] = session.username
+    mime["To"] = ",".join(to) if isinstance(to,list) else to
+    mime.attach(MIMEText(message["text"], "plain"))
+    mime.attach(MIMEText(message["html"], "html"))
+
+    return session.sendmail(to, mime)
+
+class Ledger:
+    ''' The record of which matches have been reported, shared by the
+    results sent to CroquetScores ("results") and those sent to the
+    opposition and observer ("oando"). Each report is appended to a
+    journal and synced to disk. From time to time the journal is folded
+    into an SQLite index and replaced by an empty one. Both are read once
+    when the Ledger is made, after which only the lines added to the
+    journal by other processes need to be read. '''
+    def __init__(self, directory="reports", compactAt=1000):
+        self.directory = Path(directory)
+        self.journal = self.directory / "ledger.log"
+        self.index = self.directory / "ledger.db"
+        self.compactAt = compactAt
+        self.lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.locked():
+            self.load()
+        if self.pending >= compactAt: self.compact()
+
+    @contextlib.contextmanager
+    def locked(self):
+        ''' Keep other processes out while the journal is read or emptied.
+        Without fcntl there is no locking between processes. '''
+        if fcntl is None:
+            yield
+            return
+        with open(self.directory / "ledger.lock", 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
             try:
-                fails = server.sendmail(sender_email,to,message.as_string())
-            except smtplib.SMTPRecipientsRefused as inst:
-                print (inst)
-                return False
-            if len(fails) >0: print (fails)
-            return len(fails) == 0
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        ''' Read the index and the journal afresh, with the lock held. '''
+        db = self.connect()
+        self.done = set(db.execute("SELECT kind, league, date, venue, home, away FROM reported"))
+        db.close()
+        self.pending = 0
+        self.offset = 0
+        self.inode = None
+        self.catchUp()
+
+    def catchUp(self):
+        ''' Read the lines added to the journal since it was last read, by
+        this or another process, with the lock held. If the journal has
+        been replaced by a compaction everything is read again. '''
+        try:
+            stat = os.stat(self.journal)
+        except FileNotFoundError:
+            return
+        if self.inode is not None and (stat.st_ino != self.inode or stat.st_size < self.offset):
+            self.load()
+            return
+        self.inode = stat.st_ino
+        with open(self.journal, 'rb') as f:
+            f.seek(self.offset)
+            for jsonobj in f:
+                # A line without its end is being written or was left by a crash
+                if not jsonobj.endswith(b"\n"): break
+                self.offset += len(jsonobj)
+                try:
+                    self.done.add(tuple(json.loads(jsonobj)))
+                except ValueError:
+                    continue
+                self.pending += 1
+
+    def refresh(self):
+        ''' Pick up the matches reported by other processes. '''
+        with self.lock, self.locked():
+            self.catchUp()
+
+    def connect(self):
+        ''' Open the index, creating it from any old per league reports
+        files if it does not yet exist. A database file left empty by a
+        crash is treated as not existing. '''
+        db = sqlite3.connect(self.index)
+        new = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'reported'").fetchone() is None
+        db.execute("CREATE TABLE IF NOT EXISTS reported (kind, league, date, venue, home, away, PRIMARY KEY (kind, league, date, venue, home, away)) WITHOUT ROWID")
+        if new:
+            for fname in self.directory.glob("*.json"):
+                with open(fname) as f:
+                    for jsonobj in f:
+                        if fname.stem.endswith(" oando"):
+                            row = ("oando", fname.stem[:-len(" oando")]) + tuple(json.loads(jsonobj))
+                        else:
+                            key, val = json.loads(jsonobj)
+                            row = ("results", fname.stem) + tuple(key)
+                        db.execute("INSERT OR IGNORE INTO reported VALUES (?,?,?,?,?,?)", row)
+            db.commit()
+        return db
+
+    def isDone(self, kind, league, key):
+        ''' Return True if the match with this key has been reported. '''
+        return (kind, league) + tuple(key) in self.done
+
+    def record(self, kind, league, key):
+        ''' Note that a match has been reported. '''
+        row = (kind, league) + tuple(key)
+        with self.lock, self.locked():
+            self.catchUp()
+            with open(self.journal, 'ab') as f:
+                f.write((json.dumps(row) + "\n").encode())
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+            self.inode = os.stat(self.journal).st_ino
+            self.done.add(row)
+            self.pending += 1
+
+    def compact(self):
+        ''' Move everything in the journal into the index. '''
+        with self.lock, self.locked():
+            if not self.journal.is_file(): return
+            rows = []
+            with open(self.journal) as f:
+                for jsonobj in f:
+                    try:
+                        rows.append(tuple(json.loads(jsonobj)))
+                    except ValueError:
+                        continue
+            db = self.connect()
+            with db:
+                db.executemany("INSERT OR IGNORE INTO reported VALUES (?,?,?,?,?,?)", rows)
+            db.close()
+            self.done.update(rows)
+            # A new file so that other processes can tell it has been compacted
+            tmp = self.journal.with_suffix(".tmp")
+            with open(tmp, 'w') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journal)
+            self.inode = os.stat(self.journal).st_ino
+            self.offset = 0
+            self.pending = 0
+
+class Outbox:
+    ''' A spool directory of emails waiting to be sent. Each entry is a
+    json file holding a list of messages, to be sent in order, and the
+    match to record in the Ledger once they have all been delivered. '''
+    def __init__(self, directory="outbox"):
+        self.directory = Path(directory)
+
+    def enqueue(self, messages, kind, league, key):
+        ''' Store messages for delivery unless there is already an entry
+        for the same report waiting, so that nothing is sent twice. '''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / (hashlib.sha1(json.dumps([kind, league, key]).encode()).hexdigest() + ".json")
+        if path.is_file(): return
+        entry = {"messages": messages, "kind": kind, "league": league, "key": key, "sent": 0, "attempts": 0, "due": 0}
+        self.write(path, entry)
+        metrics.count("emails", len(messages), "queued")
+
+    def write(self, path, entry):
+        ''' Write an entry so that it is never seen half written. '''
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def entries(self):
+        ''' Return the paths of all the waiting entries. '''
+        if not self.directory.is_dir(): return []
+        return sorted(self.directory.glob("*.json"))
+
+def drainOutbox(outbox, ledger, workers=4, maxAttempts=5, backoff=30, sessionFactory=MailSession, wait=False):
+    ''' Deliver everything in the outbox that is due using up to workers
+    connections at once. A failed entry is retried after backoff seconds,
+    doubling each time, and moved to the failed directory after
+    maxAttempts. Entries not yet due are left for the next call unless
+    wait is True, in which case it sleeps until they are due. The match
+    is only recorded in the ledger once all of an entry's messages have
+    been delivered.
+
+    Returns: the number of entries delivered
+    '''
+    local = threading.local()
+    sessions = []
+    lock = threading.Lock()
+
+    def deliver(path):
+        with open(path) as f:
+            entry = json.load(f)
+        if not hasattr(local, "session"):
+            local.session = sessionFactory()
+            with lock: sessions.append(local.session)
+        session = local.session
+        try:
+            while entry["sent"] < len(entry["messages"]):
+                if not sendHtmlMail(entry["messages"][entry["sent"]], session):
+                    metrics.count("emails", 1, "failed")
+                    break
+                entry["sent"] += 1
+                metrics.count("emails", 1, "sent")
+        except (smtplib.SMTPException, OSError) as inst:
+            print ("Failed to send", path.name, inst)
+            metrics.count("emails", 1, "failed")
+            session.close()
+
+        if entry["sent"] == len(entry["messages"]):
+            ledger.record(entry["kind"], entry["league"], entry["key"])
+            os.remove(path)
+            return True
+
+        entry["attempts"] += 1
+        if entry["attempts"] >= maxAttempts:
+            print ("Giving up on", path.name, "after", entry["attempts"], "attempts")
+            (outbox.directory / "failed").mkdir(exist_ok=True)
+            os.replace(path, outbox.directory / "failed" / path.name)
+        else:
+            entry["due"] = time.time() + backoff * 2 ** (entry["attempts"] - 1)
+            outbox.write(path, entry)
+        return False
+
+    delivered = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                waiting = []
+                for path in outbox.entries():
+                    with open(path) as f:
+                        waiting.append((json.load(f)["due"], path))
+                if not waiting: break
+                now = time.time()
+                due = [path for when, path in waiting if when <= now]
+                if not due:
+                    if not wait: break
+                    time.sleep(min(when for when, path in waiting) - now)
+                    continue
+                delivered += sum(pool.map(deliver, due))
+    finally:
+        for session in sessions: session.close()
+    if ledger.pending >= ledger.compactAt: ledger.compact()
+    return delivered
+
+def processSeason(configFile, args, directory="."):
+    ''' Produce the tables and reports for the season described by a
+    config file, putting the tables, reports, outbox and checkpoints
+    directories in the given directory.
+
+    Returns: the summary line of each league
+
+    '''
+    base = Path(directory)
+    tables = base / "tables"
+    tables.mkdir(parents=True, exist_ok=True)
+
+    # Find the config file and read it
+    captains, results, corrections, people, fixtures = readConfig(configFile)
+   
+    if args.incremental:
+        # Apply new responses to the leagues saved by the last run
+        with metrics.stage("readIncremental"):
+            leagues = readIncremental(configFile, captains, results, corrections, people, args.numpy, fixtures, base / "checkpoints")
+    elif args.database:
+        # Bring the season up to date in the database and query it
+        db = openDatabase(args.database)
+        with metrics.stage("ingestSeason"):
+            ingestSeason(db, configFile, captains, results, corrections, base / "checkpoints")
+        with metrics.stage("readResults"):
+            games = readResultsFromDb(db, configFile)
+        with metrics.stage("getLeagues"):
+            leagues = getLeaguesFromDb(db, configFile, people, args.numpy, fixtures)
+        with metrics.stage("populateLeagues"):
+            recordGames(games, leagues)
+        db.close()
     else:
-        return True
-        
+        # Read in the file of corrections
+        with metrics.stage("getCordict"):
+            cordict = getCordict(corrections, base / "checkpoints")
+    
+        # Now read the results
+        with metrics.stage("readResults"):
+            data = readResults(results, cordict)
+
+        # Find what matches should be played
+        with metrics.stage("getLeagues"):
+            leagues = getLeagues(captains, people, args.numpy, fixtures)
+    
+        # Now fill the league tales with results
+        with metrics.stage("populateLeagues"):
+            populateLeagues(data, leagues)
+              
+    # Now produce tables
+    return emitLeagues(leagues, args, base)
+
+def emitLeagues(leagues, args, base, names=None, ledger=None):
+    ''' Write the tables of the named leagues, by default all of them,
+    queue their reports and publish them if wanted. A Ledger kept from
+    an earlier call may be passed in to save reading it again.
+
+    Returns: the summary line of each league written
+
+    '''
+    tables = base / "tables"
+    outbox = Outbox(base / "outbox")
+    if ledger is None: ledger = Ledger(base / "reports")
+    else: ledger.refresh()
+    manifest = readManifest(tables / ".manifest.json")
+    changed = False
+    summary = []
+    for name in leagues:
+        if names is not None and name not in names: continue
+        league = leagues[name]
+        print (league)
+        summary.append(str(league))
+        metrics.set("games", len(league.games), name)
+        with metrics.stage("tables"):
+            for fname, write in ((str(tables / (name+"_table.json")), league.writeTable), (str(tables / (name+"_games.json")), league.writeGamesTable)):
+                if writeAtomically(fname, write, manifest):
+                    changed = True
+                    print ("Changed", fname)
+                    metrics.set("table_bytes", os.path.getsize(fname), Path(fname).name)
+        if name in ("A Level", "B Level", "C Level"):
+            with metrics.stage("reports"):
+                league.reportResults(outbox, ledger)
+                league.reportToOppos(outbox, ledger)
+    if changed: saveManifest(str(tables / ".manifest.json"), manifest)
+
+    if args.publish:
+        with metrics.stage("publish"):
+            for fname in publishTables(args.publish, str(tables)): print ("Published", fname)
+    return summary
+
+class TableServer:
+    ''' Serve each league's table and games json, as written to the
+    tables directory, over HTTP from memory. Bodies are built when first
+    asked for and kept until that league records another game. They
+    carry strong ETags, honour If-None-Match and are gzipped for clients
+    that accept it. '''
+    def __init__(self, leagues):
+        self.leagues = leagues
+        self.cache = {}
+
+    def entry(self, name):
+        ''' Return (etag, body, gzipped body) for a file name such as
+        "A Level_table.json" or None if there is no such file. '''
+        for suffix, make in (("_table.json", League.table), ("_games.json", League.gamesTable)):
+            if name.endswith(suffix) and name[:-len(suffix)] in self.leagues:
+                league = self.leagues[name[:-len(suffix)]]
+                # Kept with the league itself, as an id may be reused once a league is freed
+                cached = self.cache.get(name)
+                if cached is None or cached[0] is not league or cached[1] != league.version:
+                    body = make(league).encode()
+                    cached = self.cache[name] = (league, league.version, '"' + hashlib.sha1(body).hexdigest() + '"', body, gzip.compress(body))
+                return cached[2:]
+        return None
+
+    async def handle(self, reader, writer):
+        ''' Answer a single request and close the connection. '''
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""): break
+                key, sep, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if len(request) < 2 or request[0] not in ("GET", "HEAD"):
+                self.respond(writer, "405 Method Not Allowed", b"", {"Allow": "GET, HEAD"})
+            else:
+                name = urllib.parse.unquote(request[1].split("?")[0]).lstrip("/")
+                if name == "":
+                    names = [league + suffix for league in self.leagues for suffix in ("_table.json", "_games.json")]
+                    self.respond(writer, "200 OK", json.dumps(names).encode(), {"Content-Type": "application/json"}, request[0] == "HEAD")
+                else:
+                    entry = self.entry(name)
+                    if entry is None:
+                        self.respond(writer, "404 Not Found", b"")
+                    else:
+                        etag, body, gzipped = entry
+                        useGzip = "gzip" in headers.get("accept-encoding", "")
+                        if useGzip:
+                            etag = etag[:-1] + '-gzip"'
+                            body = gzipped
+                        extra = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache", "Content-Type": "application/json"}
+                        if useGzip: extra["Content-Encoding"] = "gzip"
+                        # Weak comparison, as RFC 9110 asks of If-None-Match
+                        tags = [tag.strip() for tag in headers.get("if-none-match", "").split(",")]
+                        match = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+                        if etag in match or "*" in match:
+                            self.respond(writer, "304 Not Modified", b"", extra, True)
+                        else:
+                            self.respond(writer, "200 OK", body, extra, request[0] == "HEAD")
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body, extra=None, headOnly=False):
+        ''' Write a response. '''
+        lines = ["HTTP/1.1 " + status, "Access-Control-Allow-Origin: *", "Connection: close"]
+        # A 304 has no body and must not claim the length of one
+        if not status.startswith("304"): lines.insert(1, "Content-Length: " + str(len(body)))
+        if extra: lines.extend(key + ": " + value for key, value in extra.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not headOnly: writer.write(body)
+
+def watchSeason(configFile, args, directory=".", interval=5, serve=None):
+    ''' Keep the leagues of a season in memory, checking every interval
+    seconds whether the config, results, corrections, captains or
+    fixtures files have changed. New responses are applied as by
+    readIncremental and only the leagues they change are written out
+    again. The checkpoint is saved after each change so a restart
+    carries on where this left off. A refresh that fails is reported and
+    tried again at the next check. The metrics saved, if wanted, are
+    those of the latest refresh. If serve is given as [host:]port the
+    tables are also served over HTTP by a TableServer. '''
+    base = Path(directory)
+    (base / "tables").mkdir(parents=True, exist_ok=True)
+    checkpoints = base / "checkpoints"
+    fname = os.path.join(checkpoints, Path(configFile).name + ".pickle")
+    state = None
+    if Path(fname).is_file():
+        with open(fname, 'rb') as f:
+            state = pickle.load(f)
+
+    def snapshot(paths):
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except (OSError, TypeError):
+                stats.append(None)
+        return stats
+
+    seen = None
+    emitted = {}
+    server = TableServer({})
+    ledger = Ledger(base / "reports")
+
+    def refresh():
+        nonlocal state
+        try:
+            check()
+        except Exception as inst:
+            # Such as a file being replaced, so try again next time from
+            # scratch as the state may be half updated
+            print ("Refresh failed with", inst.__class__.__name__, inst)
+            state = None
+            sys.stdout.flush()
+
+    def check():
+        global metrics
+        nonlocal state, seen, emitted
+        captains, results, corrections, people, fixtures = readConfig(configFile)
+        paths = [configFile + ".ini", results, corrections, captains, fixtures]
+        stats = snapshot(paths)
+        if stats != seen:
+            # The metrics saved describe this refresh alone, as gauges should
+            metrics = Metrics(args.profile)
+            with metrics.stage("readIncremental"):
+                state = updateIncremental(state, captains, results, corrections, people, args.numpy, fixtures, checkpoints)
+            saveCheckpoint(fname, state)
+            leagues = state["leagues"]
+            server.leagues = leagues
+            changed = [name for name, league in leagues.items() if name not in emitted or emitted[name][0] is not league or emitted[name][1] != league.version]
+            if changed: emitLeagues(leagues, args, base, changed, ledger)
+            emitted = {name: (league, league.version) for name, league in leagues.items()}
+            saveMetrics(args, base)
+            # Anything changing while we were busy is picked up next time
+            seen = stats
+            sys.stdout.flush()
+
+    async def serveAndRefresh():
+        host, sep, port = serve.rpartition(":")
+        listener = await asyncio.start_server(server.handle, host or "localhost", int(port))
+        async with listener:
+            while True:
+                refresh()
+                await asyncio.sleep(interval)
+
+    try:
+        if serve:
+            asyncio.run(serveAndRefresh())
+        else:
+            while True:
+                refresh()
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+def processBatchSeason(configFile, args):
+    ''' Run processSeason in a worker process with its output going to
+    update.log in the season's own directory under args.outdir.
+
+    Returns: configFile and the summary lines
+
+    '''
+    global mailWanted, printWanted, reportWanted, metrics, playerIndex
+    mailWanted = args.mailWanted
+    printWanted = args.verbose
+    reportWanted = args.reportWanted
+    metrics = Metrics(args.profile)
+    if args.players: playerIndex = PlayerIndex(Path(args.outdir) / "players.idx")
+    directory = Path(args.outdir) / Path(configFile).name
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / "update.log", 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            return configFile, processSeason(configFile, args, directory)
+        finally:
+            saveMetrics(args, directory)
+
+def saveMetrics(args, directory):
+    ''' Write the metrics file and profile asked for by args, a metrics
+    file given by name alone going in the directory. '''
+    if args.metrics:
+        fname = Path(args.metrics)
+        metrics.save(fname if fname.parent != Path(".") else Path(directory) / fname)
+    if args.profile:
+        metrics.dumpProfile(Path(directory) / (args.profile + ".prof"))
+
+def updatePlayerIndex(configFiles, directory="."):
+    ''' Bring the player index in the given directory up to date with the
+    seasons described by a list of config files.
+
+    Returns: the PlayerIndex
+
+    '''
+    seasons = []
+    for configFile in dict.fromkeys(configFiles):
+        captains, results, corrections, people, fixtures = readConfig(configFile)
+        seasons.append((configFile, results, corrections))
+    index = PlayerIndex(Path(directory) / "players.idx")
+    for season in index.update(seasons, Path(directory) / "checkpoints"): print ("Indexed players of", season)
+    return index
+
+def printPlayer(index, name):
+    ''' Print the games and handicap history of a player. '''
+    if index.playerId(name) is None:
+        print ("No player", name, "in the index")
+        for close in difflib.get_close_matches(normaliseName(name), index.ids, n=5, cutoff=0.6): print ("Perhaps", index.names[index.ids[close]])
+        return
+    for season, day, handicap, score, opponent, against in index.games(name):
+        print (season, day, "handicap", "%g" % handicap, "scored", score, "against", against, "by", opponent)
+    print ("Handicaps:", ", ".join(str(day) + " " + "%g" % handicap for day, handicap in index.handicaps(name)))
+
+def run(args):
+    ''' Do what the command line asks for. '''
+    global playerIndex
+    if args.players:
+        # Check names against the index of every season given and this one
+        with metrics.stage("updatePlayerIndex"):
+            playerIndex = updatePlayerIndex(args.players + (args.batch or [args.configfile]), args.outdir)
+
+    if args.player:
+        printPlayer(playerIndex or PlayerIndex(Path(args.outdir) / "players.idx"), args.player)
+        return
+
+    if args.drain_outbox:
+        with metrics.stage("drainOutbox"):
+            sessionFactory = MailSession
+            if args.smtp:
+                # A local server such as python -m aiosmtpd -n, without SSL or login
+                host, sep, port = args.smtp.rpartition(":")
+                sessionFactory = lambda: MailSession(host or "localhost", int(port), useSsl=False)
+            print ("Delivered", drainOutbox(Outbox(Path(args.outdir) / "outbox"), Ledger(Path(args.outdir) / "reports"), args.workers, sessionFactory=sessionFactory, wait=args.wait))
+        return
+
+    if args.batch:
+        # Each season in its own process and directory
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(processBatchSeason, configFile, args) for configFile in args.batch]
+            for configFile, future in zip(args.batch, futures):
+                try:
+                    configFile, summary = future.result()
+                except Exception as inst:
+                    print (configFile + ": failed with", inst.__class__.__name__, inst)
+                    continue
+                for line in summary: print (configFile + ": " + line)
+        return
+
+    if args.watch or args.serve:
+        watchSeason(args.configfile, args, args.outdir, args.interval, args.serve)
+        return
+
+    processSeason(args.configfile, args, args.outdir)
+
 def main():
     ''' Main program. '''
 
@@ -437,37 +2053,41 @@ def main():
     parser.add_argument("-r", "--reportWanted", action="store_true", help="send rankings")
     parser.add_argument("-v", "--verbose", action="store_true", help="list text version of emails that will be sent unless -n selected")
     parser.add_argument("-c", "--configfile", default="default")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-i", "--incremental", action="store_true", help="only read responses added since the last incremental run")
+    source.add_argument("--database", metavar="FILE", help="load the season into an SQLite database and work from that")
+    parser.add_argument("--numpy", action="store_true", help="hold the cross tables in NumPy arrays")
+    parser.add_argument("-p", "--publish", metavar="DEST", help="copy the tables that have changed since they were last published to DEST, a directory or scp destination")
+    parser.add_argument("-d", "--drain-outbox", action="store_true", help="send the emails waiting in the outbox and exit")
+    parser.add_argument("--wait", action="store_true", help="with --drain-outbox keep retrying failed emails until they are sent or given up rather than leaving them for the next run")
+    parser.add_argument("--smtp", metavar="[HOST:]PORT", help="drain the outbox through a plain SMTP server, on localhost unless a host is given, instead of logging in to the real one")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of mail server connections used to drain the outbox")
+    parser.add_argument("-o", "--outdir", default=".", help="directory for tables, reports, outbox and checkpoints; with --batch each config gets a directory of its own name within it")
+    parser.add_argument("--watch", action="store_true", help="keep running, updating the tables whenever the input files change")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="serve the tables over HTTP while watching, on localhost unless a host is given")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between checks for changes with --watch")
+    parser.add_argument("-b", "--batch", nargs="+", metavar="CONFIG", help="process several config files at once in separate processes; not with --watch, --serve or --publish")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes used by --batch")
+    parser.add_argument("--metrics", metavar="FILE", help="write stage timings and counts to FILE after each run, in the Prometheus text format if it ends in .prom and otherwise as json; a bare name goes in the output directory")
+    parser.add_argument("--players", nargs="+", metavar="CONFIG", help="keep an index of the players of these seasons and this one in players.idx in the output directory and check the names reported against it")
+    parser.add_argument("--player", metavar="NAME", help="list the games and handicaps of a player from the index and exit")
+    parser.add_argument("--profile", metavar="STAGE", help="profile a stage, e.g. populateLeagues or reports, writing STAGE.prof to the output directory")
     args = parser.parse_args()
+    if args.batch and (args.watch or args.serve):
+        parser.error("--batch cannot be combined with --watch or --serve")
+    if args.batch and args.publish:
+        # Every season's tables have the same names so would overwrite each other at DEST
+        parser.error("--batch cannot be combined with --publish")
     global mailWanted, printWanted, reportWanted
     mailWanted = args.mailWanted
     printWanted = args.verbose
     reportWanted = args.reportWanted
+    metrics.profileStage = args.profile
 
-    # Find the config file and read it
-    captains, results, corrections, people = readConfig(args.configfile)
-   
-    # Read in the file of corrections
-    cordict = getCordict(corrections)
-    
-    # Now read the results
-    data = readResults(results, cordict)
-
-    # Find what matches should be played
-    leagues = getLeagues(captains, people)
-    
-    # Now fill the league tales with results
-    populateLeagues(data, leagues)
-              
-    # Now produce tables
-    for name in leagues:
-        league = leagues[name]
-        print (league)
-        with open("tables/"+name+"_table.json",'w') as f:
-            f.write(league.table())
-        with open("tables/"+name+"_games.json",'w') as f:
-            f.write(league.gamesTable())
-        if name in ("A Level", "B Level", "C Level"):
-            league.reportResults()
-            league.reportToOppos()
+    try:
+        run(args)
+    finally:
+        # Batch and watch runs save their own
+        if not (args.batch or args.watch or args.serve): saveMetrics(args, args.outdir)
         
 if __name__ == '__main__': main()